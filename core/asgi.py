@@ -11,6 +11,10 @@ import os
 
 from django.core.asgi import get_asgi_application
 
+from core.mime import register_mimetypes
+
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
 
+register_mimetypes()
+
 application = get_asgi_application()
@@ -0,0 +1,30 @@
+"""
+Отдача /media/ при разработке (DEBUG) до сессий, CSRF, авторизации и аналитики.
+
+/static/ в DEBUG уже перехватывает WhiteNoise сразу после SecurityMiddleware;
+этот middleware делает то же самое для загрузок. В проде оба пути отдаёт Caddy.
+"""
+from django.conf import settings
+from django.http import Http404
+from django.views.decorators.cache import cache_control
+from django.views.static import serve
+
+_serve_media = cache_control(public=True, max_age=604800)(serve)
+
+
+class DebugMediaMiddleware:
+    def __init__(self, get_response):
+        self.get_response = get_response
+        self.prefix = settings.MEDIA_URL
+
+    def __call__(self, request):
+        if request.path.startswith(self.prefix) and request.method in ("GET", "HEAD"):
+            try:
+                return _serve_media(
+                    request,
+                    request.path[len(self.prefix):],
+                    document_root=settings.MEDIA_ROOT,
+                )
+            except Http404:
+                pass  # пусть обычный 404 отрисует Django
+        return self.get_response(request)
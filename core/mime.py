@@ -0,0 +1,14 @@
+"""
+Регистрация MIME-типов, которых может не быть в системной базе.
+
+Нужна только процессам, которые сами отдают файлы (runserver, WhiteNoise,
+django.views.static.serve), поэтому вызывается из wsgi/asgi, а не из settings:
+manage.py-команды и бот не тратят время на mimetypes.init().
+"""
+import mimetypes
+
+
+def register_mimetypes() -> None:
+    mimetypes.add_type("image/webp", ".webp", strict=True)
+    mimetypes.add_type("image/avif", ".avif", strict=True)
+    mimetypes.add_type("image/svg+xml", ".svg", strict=True)
@@ -3,26 +3,33 @@
 Документация: https://docs.djangoproject.com/en/5.2/
 """
 
-from pathlib import Path
 import os
-import mimetypes
-
-mimetypes.init()
-mimetypes.add_type("image/webp", ".webp", strict=True)
-mimetypes.add_type("image/avif", ".avif", strict=True)
-mimetypes.add_type("image/svg+xml", ".svg", strict=True)
 
 # ──────────────────────────────────────────────────────────────
 # БАЗА
 # ──────────────────────────────────────────────────────────────
-BASE_DIR = Path(__file__).resolve().parent.parent
+# обычные строки вместо Path: меньше объектов и stat() при каждом импорте настроек
+BASE_DIR = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+# Опционально подхватываем .env локально (в Docker переменные уже передаются из env_file).
+# dotenv импортируем только если файл есть — не платим за импорт в каждом процессе.
+_env_file = os.path.join(BASE_DIR, ".env")
+if os.path.exists(_env_file):
+    try:
+        from dotenv import load_dotenv  # type: ignore
+        load_dotenv(_env_file)
+    except Exception:
+        pass
+
+
+def _env_bool(key: str, default: str = "0") -> bool:
+    return os.getenv(key, default) in ("1", "true", "True")
+
+
+def _env_list(key: str, default: str = "") -> list:
+    """Список из переменной через запятую: пробелы срезаем один раз, пустые выкидываем."""
+    return [v for v in map(str.strip, os.getenv(key, default).split(",")) if v]
 
-# Опционально подхватываем .env локально (в Docker переменные уже передаются из env_file)
-try:
-    from dotenv import load_dotenv  # type: ignore
-    load_dotenv(BASE_DIR / ".env")
-except Exception:
-    pass
 
 # Секретный ключ
 SECRET_KEY = os.getenv("DJANGO_SECRET_KEY", "unsafe-dev-key-change-me")
@@ -37,13 +44,13 @@ DEBUG = os.getenv("DJANGO_DEBUG", "false").lower() == "true"
 
 # Разрешённые хосты
 
-ALLOWED_HOSTS = [h.strip() for h in os.getenv("DJANGO_ALLOWED_HOSTS", "127.0.0.1,localhost").split(",") if h.strip()]
+ALLOWED_HOSTS = _env_list("DJANGO_ALLOWED_HOSTS", "127.0.0.1,localhost")
 
 # Базовый URL сайта (для ссылок в уведомлениях)
 SITE_URL = os.getenv("SITE_URL", "").rstrip("/")
 
 # CSRF trusted origins (должны быть полными origin с протоколом)
-_csrf_from_env = [o.strip() for o in os.getenv("DJANGO_CSRF_TRUSTED_ORIGINS", "").split(",") if o.strip()]
+_csrf_from_env = _env_list("DJANGO_CSRF_TRUSTED_ORIGINS")
 if _csrf_from_env:
     CSRF_TRUSTED_ORIGINS = _csrf_from_env
 elif SITE_URL.startswith(("http://", "https://")):
@@ -54,12 +61,20 @@ else:
 # ──────────────────────────────────────────────────────────────
 # ПРИЛОЖЕНИЯ
 # ──────────────────────────────────────────────────────────────
-INSTALLED_APPS = [
+# Процессам без веб-админки (TG-бот, разовые команды) unfold и admin не нужны:
+# с DJANGO_SKIP_ADMIN=1 django.setup() не импортирует их и не делает autodiscover admin.py.
+SKIP_ADMIN = _env_bool("DJANGO_SKIP_ADMIN")
+
+_ADMIN_APPS = [
     "unfold",                 # до django.contrib.admin
     "unfold.contrib.filters",
     "unfold.contrib.forms",
 
     "django.contrib.admin",
+]
+
+INSTALLED_APPS = [
+    *([] if SKIP_ADMIN else _ADMIN_APPS),
     "django.contrib.auth",
     "django.contrib.contenttypes",
     "django.contrib.sessions",
@@ -76,9 +91,9 @@ INSTALLED_APPS = [
 # ──────────────────────────────────────────────────────────────
 MIDDLEWARE = [
     "django.middleware.security.SecurityMiddleware",
-    "whitenoise.middleware.WhiteNoiseMiddleware",  # ← сразу после SecurityMiddleware
     "django.contrib.sessions.middleware.SessionMiddleware",
-    "django.middleware.locale.LocaleMiddleware",
+    # LocaleMiddleware не нужен: язык один (LANGUAGES), активен LANGUAGE_CODE по умолчанию.
+    # MessageMiddleware оставляем — сообщения показывает запись на ремонт (repairs/base.html).
     "django.middleware.common.CommonMiddleware",
     "django.middleware.csrf.CsrfViewMiddleware",
     "django.contrib.auth.middleware.AuthenticationMiddleware",
@@ -87,19 +102,35 @@ MIDDLEWARE = [
     "repairs.middleware.AnalyticsMiddleware",
 ]
 
+# В проде /static/ и /media/ отдаёт Caddy (см. Caddyfile) напрямую с диска,
+# поэтому WhiteNoise нужен только при запуске без прокси (локально или по флагу).
+SERVE_STATIC = DEBUG or _env_bool("DJANGO_SERVE_STATIC")
+if SERVE_STATIC:
+    MIDDLEWARE.insert(1, "whitenoise.middleware.WhiteNoiseMiddleware")  # ← сразу после SecurityMiddleware
+if DEBUG:
+    # /media/ при разработке — тоже до сессий/авторизации (см. core/middleware.py)
+    MIDDLEWARE.insert(2, "core.middleware.DebugMediaMiddleware")
+
 ROOT_URLCONF = "core.urls"
 
 TEMPLATES = [
     {
         "BACKEND": "django.template.backends.django.DjangoTemplates",
-        "DIRS": [BASE_DIR / "templates"],
-        "APP_DIRS": True,
+        "DIRS": [os.path.join(BASE_DIR, "templates")],
         "OPTIONS": {
             "context_processors": [
                 "django.template.context_processors.request",
                 "django.contrib.auth.context_processors.auth",
                 "django.contrib.messages.context_processors.messages",
             ],
+            # Кэширующий загрузчик явно (вместо APP_DIRS): шаблоны компилируются
+            # один раз на процесс, а при gunicorn --preload — один раз до fork.
+            "loaders": [
+                ("django.template.loaders.cached.Loader", [
+                    "django.template.loaders.filesystem.Loader",
+                    "django.template.loaders.app_directories.Loader",
+                ]),
+            ],
         },
     },
 ]
@@ -125,6 +156,14 @@ if DB_NAME and DB_USER and DB_PASSWORD:
             "PASSWORD": DB_PASSWORD,
             "HOST": DB_HOST,
             "PORT": DB_PORT,
+            # держим соединение между запросами вместо TCP-подключения на каждый запрос
+            "CONN_MAX_AGE": int(os.getenv("DB_CONN_MAX_AGE", "60")),
+            "CONN_HEALTH_CHECKS": True,
+            # за pgbouncer в режиме transaction серверные курсоры (.iterator()) ломаются
+            "DISABLE_SERVER_SIDE_CURSORS": _env_bool("DB_PGBOUNCER"),
+            # ...и серверные prepared statements psycopg3 тоже: следующий запрос может уйти
+            # в другое серверное соединение, где такого statement нет
+            "OPTIONS": {"prepare_threshold": None} if _env_bool("DB_PGBOUNCER") else {},
         }
     }
 else:
@@ -132,7 +171,17 @@ else:
     DATABASES = {
         "default": {
             "ENGINE": "django.db.backends.sqlite3",
-            "NAME": BASE_DIR / "db.sqlite3",
+            "NAME": os.path.join(BASE_DIR, "db.sqlite3"),
+            "OPTIONS": {
+                # WAL: читатели не блокируют писателя; NORMAL — меньше fsync
+                "init_command": (
+                    "PRAGMA journal_mode=WAL;"
+                    "PRAGMA synchronous=NORMAL;"
+                    "PRAGMA temp_store=MEMORY;"
+                    "PRAGMA mmap_size=268435456;"
+                ),
+                "transaction_mode": "IMMEDIATE",
+            },
         }
     }
 
@@ -160,19 +209,32 @@ USE_TZ = True
 
 STATIC_URL = "/static/"
 # В проде обычно собираем статику сюда (например, в Docker том):
-STATIC_ROOT = os.getenv("STATIC_ROOT", str(BASE_DIR / "staticfiles"))
-
-# В режиме разработки удобно иметь /static с исходниками
-_static_dir = BASE_DIR / "static"
-
-STATICFILES_DIRS = [BASE_DIR / "static"] if (BASE_DIR / "static").exists() else []
-if not DEBUG:
-    STATICFILES_STORAGE = "whitenoise.storage.CompressedManifestStaticFilesStorage"
+STATIC_ROOT = os.getenv("STATIC_ROOT", os.path.join(BASE_DIR, "staticfiles"))
+
+# Исходники статики (каталог static/ лежит в репозитории)
+STATICFILES_DIRS = [os.path.join(BASE_DIR, "static")]
+
+# Django 5.1+ читает только STORAGES (STATICFILES_STORAGE больше не поддерживается).
+# В проде collectstatic пишет хэшированные файлы + готовые .gz/.br рядом с ними,
+# Caddy отдаёт их как есть (precompressed) без сжатия на каждый запрос.
+STORAGES = {
+    "default": {"BACKEND": "django.core.files.storage.FileSystemStorage"},
+    "staticfiles": {
+        "BACKEND": (
+            "django.contrib.staticfiles.storage.StaticFilesStorage"
+            if DEBUG
+            else "whitenoise.storage.CompressedManifestStaticFilesStorage"
+        ),
+    },
+}
+WHITENOISE_KEEP_ONLY_HASHED_FILES = True
+# не роняем страницу 500-й, если шаблон ссылается на отсутствующий файл
+WHITENOISE_MANIFEST_STRICT = False
 
 
 
 MEDIA_URL = "/media/"
-MEDIA_ROOT = BASE_DIR / "media"
+MEDIA_ROOT = os.path.join(BASE_DIR, "media")
 
 # ──────────────────────────────────────────────────────────────
 # ПРОЧЕЕ
@@ -187,16 +249,22 @@ REPAIRS_MAX_BOOK_AHEAD_DAYS = int(os.getenv("REPAIRS_MAX_BOOK_AHEAD_DAYS", "30")
 # Параметры Telegram
 TELEGRAM_BOT_TOKEN = os.getenv("TELEGRAM_BOT_TOKEN", "")
 TELEGRAM_ADMIN_CHAT_IDS = os.getenv("TELEGRAM_ADMIN_CHAT_IDS", "")
+# Если задан — бот работает через webhook (Telegram сам присылает апдейты на этот URL,
+# Caddy проксирует /tg на контейнер bot), иначе — long polling как раньше.
+TELEGRAM_WEBHOOK_URL = os.getenv("TELEGRAM_WEBHOOK_URL", "").rstrip("/")
+TELEGRAM_WEBHOOK_SECRET = os.getenv("TELEGRAM_WEBHOOK_SECRET", "")
+# потоков (и соединений с БД) у бота для запросов к базе
+TELEGRAM_DB_WORKERS = int(os.getenv("TELEGRAM_DB_WORKERS", "4"))
 
 # Флаг автозасева демо-данных (используется командами/скриптами при старте)
-SEED_DATA = os.getenv("SEED_DATA", "0") in ("1", "true", "True")
+SEED_DATA = _env_bool("SEED_DATA")
 
 # ──────────────────────────────────────────────────────────────
 # SECURITY для продакшена (включаются когда DEBUG=False)
 # ──────────────────────────────────────────────────────────────
 if not DEBUG:
     # Если стоим за прокси/Ingress и нужен корректный scheme
-    if os.getenv("ENABLE_SECURE_PROXY_SSL_HEADER", "1") in ("1", "true", "True"):
+    if _env_bool("ENABLE_SECURE_PROXY_SSL_HEADER", "1"):
         SECURE_PROXY_SSL_HEADER = ("HTTP_X_FORWARDED_PROTO", "https")
         USE_X_FORWARDED_HOST = True
 
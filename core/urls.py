@@ -1,23 +1,31 @@
 from django.contrib import admin
 from django.urls import path, include
 from django.views.generic import RedirectView, TemplateView
-from django.conf import settings
-from django.conf.urls.static import static
-from django.shortcuts import render
+from django.http import HttpResponse
+from django.template.loader import render_to_string
 from repairs.views import yoomoney_webhook
 
 # --- error handlers ---
+# Страницы ошибок — статичный HTML без переменных: рендерим один раз при загрузке URLconf
+# и отдаём готовые байты (на 500-й не трогаем шаблонизатор, сканеры 404 почти ничего не стоят).
+_HTML = "text/html; charset=utf-8"
+_BODY_404 = render_to_string("404.html").encode("utf-8")
+_BODY_403 = render_to_string("403.html").encode("utf-8")
+_BODY_400 = render_to_string("400.html").encode("utf-8")
+_BODY_500 = render_to_string("500.html").encode("utf-8")
+
+
 def err_404(request, exception):
-    return render(request, "404.html", {"path": request.path}, status=404)
+    return HttpResponse(_BODY_404, status=404, content_type=_HTML)
 
 def err_403(request, exception):
-    return render(request, "403.html", status=403)
+    return HttpResponse(_BODY_403, status=403, content_type=_HTML)
 
 def err_400(request, exception):
-    return render(request, "400.html", status=400)
+    return HttpResponse(_BODY_400, status=400, content_type=_HTML)
 
 def err_500(request):
-    return render(request, "500.html", status=500)
+    return HttpResponse(_BODY_500, status=500, content_type=_HTML)
 
 
 urlpatterns = [
@@ -37,9 +45,6 @@ urlpatterns = [
     path("", RedirectView.as_view(pattern_name="repairs:brand_list", permanent=False)),
 ]
 
-# ВАЖНО: отдаём медиа ВСЕГДА (и в dev, и в prod)
-urlpatterns += static(settings.MEDIA_URL, document_root=settings.MEDIA_ROOT)
-
 # handlers
 handler404 = "core.urls.err_404"
 handler403 = "core.urls.err_403"
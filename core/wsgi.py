@@ -11,6 +11,40 @@ import os
 
 from django.core.wsgi import get_wsgi_application
 
+from core.mime import register_mimetypes
+
 os.environ.setdefault('DJANGO_SETTINGS_MODULE', 'core.settings')
 
+register_mimetypes()
+
 application = get_wsgi_application()
+
+
+def _warm_up() -> None:
+    """
+    Прогрев ленивых частей Django до первого запроса: импорт всех urls.py,
+    компиляция URL-регэкспов и шаблонов основных страниц (кэш загрузчика).
+    Без запросов к БД — чтобы не открывать соединение до fork воркеров.
+    """
+    from django.template.loader import get_template
+    from django.urls import get_resolver, reverse
+
+    get_resolver().url_patterns
+    reverse("repairs:brand_list")  # заполняет reverse-словари резолвера
+
+    for name in (
+        "repairs/base.html",
+        "repairs/brand_list.html",
+        "news/home.html",
+        "news/detail.html",
+        "404.html",
+        "500.html",
+    ):
+        get_template(name)
+
+
+try:
+    _warm_up()
+except Exception:
+    # прогрев — только оптимизация, старт воркера он ломать не должен
+    pass
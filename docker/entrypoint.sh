@@ -20,7 +20,9 @@ PY
 done
 
 python manage.py migrate --noinput
-python manage.py collectstatic --noinput
+
+# Статика собрана при сборке образа (см. Dockerfile) — просто обновляем общий с Caddy том
+cp -a /app/static_build/. "${STATIC_ROOT:-/app/staticfiles}/"
 
 # Посев демо-данных отключён по умолчанию, включается только переменной окружения.
 if [ "${SEED_DATA:-0}" = "1" ]; then
@@ -43,4 +45,6 @@ PY
 fi
 
 echo "Starting Gunicorn..."
-exec gunicorn core.wsgi:application --bind 0.0.0.0:8000 --workers 3 --timeout 60
+# --preload: приложение (urls, шаблоны) импортируется один раз в мастере, воркеры получают его через fork
+exec gunicorn core.wsgi:application --bind 0.0.0.0:8000 --preload \
+  --workers "${GUNICORN_WORKERS:-$((2 * $(nproc) + 1))}" --timeout 60
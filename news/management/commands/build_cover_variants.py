@@ -0,0 +1,30 @@
+# news/management/commands/build_cover_variants.py
+from __future__ import annotations
+
+from django.core.management.base import BaseCommand
+
+from news.models import NewsPost
+
+
+class Command(BaseCommand):
+    help = "Создаёт AVIF/WebP-копии обложек новостей, у которых их ещё нет (разово после деплоя)."
+
+    def add_arguments(self, parser):
+        parser.add_argument("--force", action="store_true", help="Пересоздать копии для всех обложек")
+
+    def handle(self, *args, **options):
+        qs = NewsPost.objects.exclude(cover="").exclude(cover__isnull=True).only("id", "cover", "cover_formats")
+        if not options["force"]:
+            qs = qs.filter(cover_formats="")
+
+        done = 0
+        for post in qs.iterator(chunk_size=100):
+            try:
+                formats = post.build_cover_variants()
+            except Exception as exc:
+                self.stderr.write(f"#{post.pk}: {exc}")
+                continue
+            NewsPost.objects.filter(pk=post.pk).update(cover_formats=formats)
+            done += 1
+
+        self.stdout.write(self.style.SUCCESS(f"Обработано обложек: {done}"))
@@ -0,0 +1,17 @@
+# Generated by Django 5.2.5 on 2026-10-16 10:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('news', '0008_newsimage_remove_newsblock_post_and_more'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='newspost',
+            index=models.Index(condition=models.Q(('status', 'published')), fields=['-published_at', '-created_at'], include=('title', 'slug', 'excerpt', 'cover'), name='news_pub_cover_idx'),
+        ),
+    ]
@@ -0,0 +1,55 @@
+# Generated by Django 5.2.5 on 2026-10-16 10:20
+
+from django.db import migrations, models
+from django.db.models import Count, Q
+
+
+COUNTER_FIELDS = {"like": "likes", "love": "loves", "fire": "fires", "wow": "wows"}
+
+
+def fill_reaction_counters(apps, schema_editor):
+    NewsPost = apps.get_model("news", "NewsPost")
+    NewsReaction = apps.get_model("news", "NewsReaction")
+
+    rows = (
+        NewsReaction.objects
+        .values("post_id")
+        .annotate(**{
+            field: Count("id", filter=Q(reaction=reaction))
+            for reaction, field in COUNTER_FIELDS.items()
+        })
+    )
+    for row in rows:
+        post_id = row.pop("post_id")
+        NewsPost.objects.filter(pk=post_id).update(**row)
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('news', '0009_newspost_news_pub_cover_idx'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='newspost',
+            name='fires',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='🔥'),
+        ),
+        migrations.AddField(
+            model_name='newspost',
+            name='likes',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='👍'),
+        ),
+        migrations.AddField(
+            model_name='newspost',
+            name='loves',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='❤️'),
+        ),
+        migrations.AddField(
+            model_name='newspost',
+            name='wows',
+            field=models.PositiveIntegerField(default=0, editable=False, verbose_name='😮'),
+        ),
+        migrations.RunPython(fill_reaction_counters, migrations.RunPython.noop),
+    ]
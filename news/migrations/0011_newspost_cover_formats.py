@@ -0,0 +1,18 @@
+# Generated by Django 5.2.5 on 2026-10-16 10:40
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('news', '0010_newspost_reaction_counters'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='newspost',
+            name='cover_formats',
+            field=models.CharField(blank=True, editable=False, max_length=20, verbose_name='Форматы обложки'),
+        ),
+    ]
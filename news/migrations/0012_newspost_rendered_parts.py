@@ -0,0 +1,27 @@
+# Generated by Django 5.2.5 on 2026-10-16 12:10
+
+from django.db import migrations, models
+
+
+def fill_rendered_parts(apps, schema_editor):
+    from news.rendering import build_rendered_parts
+
+    NewsPost = apps.get_model("news", "NewsPost")
+    for post in NewsPost.objects.prefetch_related("images").iterator(chunk_size=200):
+        NewsPost.objects.filter(pk=post.pk).update(rendered_parts=build_rendered_parts(post))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('news', '0011_newspost_cover_formats'),
+    ]
+
+    operations = [
+        migrations.AddField(
+            model_name='newspost',
+            name='rendered_parts',
+            field=models.JSONField(blank=True, editable=False, null=True, verbose_name='Разметка текста'),
+        ),
+        migrations.RunPython(fill_rendered_parts, migrations.RunPython.noop),
+    ]
@@ -0,0 +1,25 @@
+# Generated by Django 5.2.5 on 2026-10-16 12:30
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('news', '0012_newspost_rendered_parts'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='newspost',
+            name='news_newspo_status_03d589_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='newspost',
+            name='news_newspo_categor_a5d2e0_idx',
+        ),
+        migrations.AddIndex(
+            model_name='newspost',
+            index=models.Index(condition=models.Q(('status', 'published')), fields=['category', '-published_at', '-created_at'], name='news_pub_cat_idx'),
+        ),
+    ]
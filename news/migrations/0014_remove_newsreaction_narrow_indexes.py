@@ -0,0 +1,21 @@
+# Generated by Django 5.2.5 on 2026-10-16 13:20
+
+from django.db import migrations
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('news', '0013_newspost_news_pub_cat_idx'),
+    ]
+
+    operations = [
+        migrations.RemoveIndex(
+            model_name='newsreaction',
+            name='news_newsre_post_id_00df8a_idx',
+        ),
+        migrations.RemoveIndex(
+            model_name='newsreaction',
+            name='news_newsre_post_id_8cd525_idx',
+        ),
+    ]
@@ -1,11 +1,31 @@
+import io
+import os
+import posixpath
+
 from django.conf import settings
+from django.core.cache import cache
+from django.core.files.base import ContentFile
 from django.db import models
-from django.db.models import Q
+from django.db.models import F, Q
+from django.db.models.functions import Greatest
+from django.db.models.signals import post_delete, post_save
+from django.dispatch import receiver
 from django.utils import timezone
 from django.urls import reverse
 from django.core.exceptions import ValidationError
 
 
+# Облегчённые копии обложки, которые генерируем при загрузке: (расширение, формат PIL, MIME, параметры)
+COVER_VARIANTS = (
+    ("avif", "AVIF", "image/avif", {"quality": 50}),
+    ("webp", "WEBP", "image/webp", {"quality": 80}),
+)
+
+
+# кэш пары категорий для блоков главной (см. NewsHomeView); сбрасывается при правке категорий
+BLOCK_CATEGORIES_CACHE_KEY = "news:block_cats"
+
+
 class NewsCategory(models.Model):
     """
     Категории новостей.
@@ -48,8 +68,12 @@ class NewsPost(models.Model):
         blank=True,
         help_text="Можно вставлять картинки плейсхолдерами: {{img:1}} ... {{img:5}}",
     )
+    # готовая разметка content (см. news/rendering.py); None — ещё не собрана
+    rendered_parts = models.JSONField("Разметка текста", null=True, blank=True, editable=False)
 
     cover = models.ImageField("Обложка", upload_to="news/cover/", blank=True, null=True)
+    # какие копии обложки лежат рядом с оригиналом, например "avif,webp"
+    cover_formats = models.CharField("Форматы обложки", max_length=20, blank=True, editable=False)
 
     # Автор
     author_user = models.ForeignKey(
@@ -68,15 +92,34 @@ class NewsPost(models.Model):
     created_at = models.DateTimeField("Создано", auto_now_add=True)
     updated_at = models.DateTimeField("Обновлено", auto_now=True)
 
+    # Счётчики реакций (денормализация NewsReaction, обновляются сигналами ниже)
+    likes = models.PositiveIntegerField("👍", default=0, editable=False)
+    loves = models.PositiveIntegerField("❤️", default=0, editable=False)
+    fires = models.PositiveIntegerField("🔥", default=0, editable=False)
+    wows = models.PositiveIntegerField("😮", default=0, editable=False)
+
     class Meta:
         verbose_name = "Новость"
         verbose_name_plural = "Новости"
         ordering = ["-published_at", "-created_at"]
         indexes = [
-            models.Index(fields=["status", "-published_at"]),
             models.Index(fields=["slug"]),
-            models.Index(fields=["category", "status", "-published_at"]),
+            # лента категории: только опубликованные (черновики/архив в индекс не попадают),
+            # ORDER BY как в Meta.ordering — без сортировки
+            models.Index(
+                fields=["category", "-published_at", "-created_at"],
+                condition=Q(status="published"),
+                name="news_pub_cat_idx",
+            ),
             models.Index(fields=["author_user"]),
+            # частичный покрывающий индекс под ленту: только опубликованные, порядок = Meta.ordering,
+            # колонки карточки в INCLUDE (на Postgres — index-only scan; SQLite INCLUDE игнорирует)
+            models.Index(
+                fields=["-published_at", "-created_at"],
+                include=["title", "slug", "excerpt", "cover"],
+                condition=Q(status="published"),
+                name="news_pub_cover_idx",
+            ),
         ]
 
     def __str__(self):
@@ -100,11 +143,116 @@ class NewsPost(models.Model):
         # Ограничение источников и картинок (мягко: контролируем на уровне связанных моделей в их clean)
         super().clean()
 
+    def _cover_variant_name(self, ext: str) -> str:
+        # news/cover/foo.jpg -> news/cover/variants/foo.jpg.webp: полное имя оригинала уникально
+        # в storage (foo.jpg и foo.png дают разные копии), а в variants/ загрузки не попадают —
+        # по этому пути лежит только копия этой обложки, её и перезаписываем
+        head, tail = posixpath.split(self.cover.name)
+        return posixpath.join(head, "variants", f"{tail}.{ext}")
+
+    @property
+    def cover_sources(self) -> list[dict]:
+        """<source> для <picture>: [{"type": "image/avif", "url": "..."}, ...] — только реально созданные."""
+        if not self.cover or not self.cover_formats:
+            return []
+        ready = set(self.cover_formats.split(","))
+        return [
+            {"type": mime, "url": self.cover.storage.url(self._cover_variant_name(ext))}
+            for ext, _fmt, mime, _opts in COVER_VARIANTS
+            if ext in ready
+        ]
+
+    def build_cover_variants(self) -> str:
+        """
+        Генерирует AVIF/WebP-копии обложки в variants/ рядом с оригиналом (см. _cover_variant_name).
+        Возвращает список получившихся форматов через запятую — для cover_formats.
+        Форматы, которые не умеет текущая сборка Pillow, молча пропускаются.
+        """
+        if not self.cover:
+            return ""
+
+        from PIL import Image, ImageOps
+        try:
+            import pillow_avif  # noqa: F401  # AVIF для сборок Pillow без встроенного libavif
+        except ImportError:
+            pass
+
+        storage = self.cover.storage
+        src_ext = os.path.splitext(self.cover.name)[1].lower().lstrip(".")
+
+        with self.cover.open("rb") as f:
+            img = Image.open(f)
+            img.load()
+        img = ImageOps.exif_transpose(img)
+        if img.mode not in ("RGB", "RGBA"):
+            img = img.convert("RGBA" if "A" in img.getbands() else "RGB")
+
+        done = []
+        for ext, fmt, _mime, opts in COVER_VARIANTS:
+            if ext == src_ext:
+                continue
+            buf = io.BytesIO()
+            try:
+                img.save(buf, format=fmt, **opts)
+            except (KeyError, OSError, ValueError):
+                continue
+            name = self._cover_variant_name(ext)
+            if storage.exists(name):
+                storage.delete(name)
+            storage.save(name, ContentFile(buf.getvalue()))
+            done.append(ext)
+        return ",".join(done)
+
     def save(self, *args, **kwargs):
+        update_fields = kwargs.get("update_fields")
+        if update_fields is not None:
+            update_fields = set(update_fields)
+
         if self.status == self.Status.PUBLISHED and not self.published_at:
             self.published_at = timezone.now()
+            # save(update_fields=["status"]) из кода не должен терять дату публикации
+            if update_fields is not None:
+                update_fields |= {"published_at", "updated_at"}
+
+        # новый файл обложки ещё не записан в storage (_committed=False) — после сохранения делаем копии
+        new_cover = bool(self.cover) and not getattr(self.cover, "_committed", True)
+        if not self.cover:
+            self.cover_formats = ""
+
+        # Разметка зависит только от content (картинки пересобирают её своим сигналом).
+        # У существующей новости собираем её до записи — уйдёт в том же UPDATE;
+        # у новой картинок ещё нет, поэтому отдельным UPDATE после INSERT.
+        render = update_fields is None or "content" in update_fields
+        adding = self._state.adding
+        if render and not adding:
+            from .rendering import build_rendered_parts
+
+            self.rendered_parts = build_rendered_parts(self)
+            if update_fields is not None:
+                update_fields.add("rendered_parts")
+
+        if update_fields is not None:
+            kwargs["update_fields"] = update_fields
         super().save(*args, **kwargs)
 
+        if new_cover:
+            try:
+                self.cover_formats = self.build_cover_variants()
+            except Exception:
+                # копии — только оптимизация трафика; без них страница отдаст оригинал
+                self.cover_formats = ""
+            NewsPost.objects.filter(pk=self.pk).update(cover_formats=self.cover_formats)
+
+        if render and adding:
+            self.refresh_rendered_parts()
+
+    def refresh_rendered_parts(self):
+        """Пересобирает разметку текста и пишет её в строку, не трогая остальные поля."""
+        from .rendering import build_rendered_parts
+
+        self.rendered_parts = build_rendered_parts(self)
+        NewsPost.objects.filter(pk=self.pk).update(rendered_parts=self.rendered_parts)
+
 
 class NewsSource(models.Model):
     """
@@ -130,7 +278,7 @@ class NewsSource(models.Model):
             qs = NewsSource.objects.filter(post_id=self.post_id)
             if self.pk:
                 qs = qs.exclude(pk=self.pk)
-            if qs.count() >= 3:
+            if qs[2:3].exists():  # есть ли уже 3-й — короткий LIMIT вместо COUNT(*)
                 raise ValidationError("Для одной новости можно указать максимум 3 источника.")
 
 
@@ -164,16 +312,11 @@ class NewsImage(models.Model):
 
     def clean(self):
         super().clean()
+        # Номер 1..5 плюс уникальность (post, position) уже дают максимум 5 картинок
+        # на новость — отдельный COUNT по базе не нужен.
         if self.position < 1 or self.position > 5:
             raise ValidationError({"position": "Номер картинки должен быть от 1 до 5."})
 
-        if self.post_id:
-            qs = NewsImage.objects.filter(post_id=self.post_id)
-            if self.pk:
-                qs = qs.exclude(pk=self.pk)
-            if qs.count() >= 5:
-                raise ValidationError("Для одной новости можно добавить максимум 5 изображений.")
-
 
 class ReactionType(models.TextChoices):
     LIKE = "like", "👍"
@@ -182,6 +325,15 @@ class ReactionType(models.TextChoices):
     WOW = "wow", "😮"
 
 
+# реакция -> поле-счётчик на NewsPost
+REACTION_COUNTER_FIELDS = {
+    ReactionType.LIKE: "likes",
+    ReactionType.LOVE: "loves",
+    ReactionType.FIRE: "fires",
+    ReactionType.WOW: "wows",
+}
+
+
 class NewsReaction(models.Model):
     post = models.ForeignKey(
         NewsPost,
@@ -206,10 +358,11 @@ class NewsReaction(models.Model):
     class Meta:
         verbose_name = "Реакция"
         verbose_name_plural = "Реакции"
+        # «мои» реакции (post + reaction + user/session_key) ищутся по частичным
+        # уникальным индексам из constraints ниже — отдельные (post, user) и
+        # (post, session_key) были бы только лишней записью на каждый клик
         indexes = [
             models.Index(fields=["post", "reaction"]),
-            models.Index(fields=["post", "user"]),
-            models.Index(fields=["post", "session_key"]),
         ]
         constraints = [
             models.UniqueConstraint(
@@ -227,3 +380,44 @@ class NewsReaction(models.Model):
     def __str__(self):
         who = self.user_id or self.session_key or "unknown"
         return f"{self.post_id} {self.reaction} ({who})"
+
+
+@receiver(post_save, sender=NewsReaction)
+def _reaction_added(sender, instance: NewsReaction, created: bool, **kwargs):
+    # loaddata: счётчики уже лежат в дампе вместе с новостью — не считаем дважды
+    if kwargs.get("raw"):
+        return
+    field = REACTION_COUNTER_FIELDS.get(instance.reaction)
+    if created and field:
+        NewsPost.objects.filter(pk=instance.post_id).update(**{field: F(field) + 1})
+
+
+@receiver(post_delete, sender=NewsReaction)
+def _reaction_removed(sender, instance: NewsReaction, **kwargs):
+    field = REACTION_COUNTER_FIELDS.get(instance.reaction)
+    if field:
+        NewsPost.objects.filter(pk=instance.post_id).update(**{field: Greatest(F(field) - 1, 0)})
+
+
+@receiver(post_save, sender=NewsImage)
+@receiver(post_delete, sender=NewsImage)
+def _image_changed(sender, instance: NewsImage, **kwargs):
+    # loaddata: разметка приходит в дампе вместе с новостью, самой новости может ещё не быть
+    if kwargs.get("raw"):
+        return
+    # картинки удаляются каскадом вместе с новостью — перерисовывать (и сохранять) её незачем
+    origin = kwargs.get("origin")
+    if origin is not None:
+        origin_model = origin.model if isinstance(origin, models.QuerySet) else type(origin)
+        if issubclass(origin_model, NewsPost):
+            return
+    # картинки из админки сохраняются инлайнами уже после самой новости
+    post = NewsPost.objects.filter(pk=instance.post_id).first()
+    if post:
+        post.refresh_rendered_parts()
+
+
+@receiver(post_save, sender=NewsCategory)
+@receiver(post_delete, sender=NewsCategory)
+def _category_changed(sender, **kwargs):
+    cache.delete(BLOCK_CATEGORIES_CACHE_KEY)
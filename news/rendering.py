@@ -0,0 +1,80 @@
+"""
+Разметка текста новости: escape, ссылки, абзацы и картинки по {{img:N}}.
+
+Результат (список частей для news/detail.html) хранится в NewsPost.rendered_parts
+и пересчитывается при сохранении новости или её картинок — не на каждый просмотр.
+"""
+import re
+
+from django.template.defaultfilters import linebreaks
+from django.utils.html import escape
+
+
+# Один проход по тексту: либо {{img:1}}..{{img:5}} (с пробелами, любой регистр),
+# либо URL https://... / http://... ("{" в URL не берём, чтобы не съесть следующий {{img}})
+_TOKEN_RE = re.compile(
+    r"(?P<img>\{\{\s*img\s*:\s*(?P<pos>[1-5])\s*\}\})|(?P<url>https?://[^\s<>()\"'{]+)",
+    re.IGNORECASE,
+)
+
+
+def _link(url: str) -> str:
+    """<a> для URL из уже escape()-нутого текста; хвостовую пунктуацию оставляем снаружи."""
+    trailing = ""
+    while url and url[-1] in ".,:;!?)]}":
+        trailing = url[-1] + trailing
+        url = url[:-1]
+
+    return (
+        f'<a href="{url}" target="_blank" rel="noopener">'
+        f"{url}"
+        f"</a>{trailing}"
+    )
+
+
+def build_rendered_parts(post) -> list:
+    """
+    - escape() всего текста один раз (на {{img:N}} и URL он не влияет)
+    - один finditer: URL -> <a>, {{img:N}} -> картинка
+    - linebreaks() для абзацев между картинками
+    """
+    content = post.content or ""
+    # нет ни одного "{{" — плейсхолдеров картинок нет, за post.images в БД не ходим
+    images = {img.position: img for img in post.images.all()} if "{{" in content else {}
+
+    text = escape(content)
+    parts = []
+    buf = []
+    last = 0
+
+    def flush():
+        html = "".join(buf)
+        buf.clear()
+        if html.strip():
+            parts.append({"type": "html", "html": linebreaks(html)})
+
+    for m in _TOKEN_RE.finditer(text):
+        buf.append(text[last:m.start()])
+        last = m.end()
+
+        if m.group("url"):
+            buf.append(_link(m.group("url")))
+            continue
+
+        flush()
+        pos = int(m.group("pos"))
+        img = images.get(pos)
+        if img and img.image:
+            parts.append(
+                {
+                    "type": "img",
+                    "url": img.image.url,
+                    "caption": (img.caption or "").strip(),
+                    "position": pos,
+                }
+            )
+
+    buf.append(text[last:])
+    flush()
+
+    return parts
@@ -1,3 +1,244 @@
-from django.test import TestCase
+import io
+import shutil
+import tempfile
+from unittest import mock, skipUnless
 
-# Create your tests here.
+from django.contrib.auth import get_user_model
+from django.core import serializers
+from django.core.files.storage import default_storage
+from django.core.files.uploadedfile import SimpleUploadedFile
+from django.test import Client, TestCase, override_settings
+from django.urls import reverse
+from PIL import Image, features
+
+from .models import NewsCategory, NewsImage, NewsPost, NewsReaction, ReactionType
+
+
+def _image_file(name: str, fmt: str, color: str) -> SimpleUploadedFile:
+    buf = io.BytesIO()
+    Image.new("RGB", (8, 8), color).save(buf, format=fmt)
+    return SimpleUploadedFile(name, buf.getvalue())
+
+
+class RenderedPartsTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = NewsCategory.objects.create(title="Мастерская", slug="workshop")
+
+    def test_filled_on_create_and_rebuilt_on_edit(self):
+        post = NewsPost.objects.create(category=self.category, title="Новость", slug="news-1", content="<b>один</b>")
+        stored = NewsPost.objects.values_list("rendered_parts", flat=True).get(pk=post.pk)
+        self.assertEqual(len(stored), 1)
+        self.assertIn("&lt;b&gt;один&lt;/b&gt;", stored[0]["html"])
+
+        post.content = "см. https://example.com."
+        post.save(update_fields=["content"])
+        stored = NewsPost.objects.values_list("rendered_parts", flat=True).get(pk=post.pk)
+        self.assertIn('<a href="https://example.com" target="_blank" rel="noopener">https://example.com</a>.', stored[0]["html"])
+
+
+class ImageChangedTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        category = NewsCategory.objects.create(title="Мастерская", slug="workshop")
+        cls.post = NewsPost.objects.create(category=category, title="Новость", slug="news-1", content="{{img:1}}")
+
+    def test_new_image_rerenders_post(self):
+        NewsImage.objects.create(post=self.post, position=1, image="news/body/one.jpg", caption="Подпись")
+        stored = NewsPost.objects.values_list("rendered_parts", flat=True).get(pk=self.post.pk)
+        self.assertEqual(stored, [{"type": "img", "url": "/media/news/body/one.jpg", "caption": "Подпись", "position": 1}])
+
+    def test_raw_save_skips_rerender(self):
+        with mock.patch.object(NewsPost, "refresh_rendered_parts") as refresh:
+            NewsImage(post=self.post, position=1, image="news/body/one.jpg").save_base(raw=True)
+        refresh.assert_not_called()
+
+    def test_post_delete_does_not_rerender_post(self):
+        NewsImage.objects.create(post=self.post, position=1, image="news/body/one.jpg")
+        NewsImage.objects.create(post=self.post, position=2, image="news/body/two.jpg")
+        with mock.patch.object(NewsPost, "refresh_rendered_parts") as refresh:
+            NewsPost.objects.filter(pk=self.post.pk).delete()
+        refresh.assert_not_called()
+        self.assertFalse(NewsImage.objects.exists())
+
+    def test_image_delete_rerenders_post(self):
+        image = NewsImage.objects.create(post=self.post, position=1, image="news/body/one.jpg")
+        image.delete()
+        stored = NewsPost.objects.values_list("rendered_parts", flat=True).get(pk=self.post.pk)
+        self.assertEqual(stored, [])  # плейсхолдер без картинки ничего не выводит
+
+
+@skipUnless(features.check("webp"), "Pillow без WebP")
+class CoverVariantsTests(TestCase):
+    @classmethod
+    def setUpClass(cls):
+        super().setUpClass()
+        cls.media_root = tempfile.mkdtemp()
+        cls.enterClassContext(override_settings(MEDIA_ROOT=cls.media_root))
+        cls.addClassCleanup(shutil.rmtree, cls.media_root, ignore_errors=True)
+
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = NewsCategory.objects.create(title="Мастерская", slug="workshop")
+
+    def _post(self, slug: str, cover: SimpleUploadedFile) -> NewsPost:
+        NewsPost.objects.create(category=self.category, title=slug, slug=slug, cover=cover)
+        return NewsPost.objects.get(slug=slug)
+
+    def _read(self, name: str) -> bytes:
+        with default_storage.open(name, "rb") as f:
+            return f.read()
+
+    def test_same_stem_covers_keep_their_own_files(self):
+        # чужая обложка с «тем самым» именем копии старой схемы (foo.jpg -> foo.webp)
+        webp_post = self._post("webp", _image_file("foo.webp", "WEBP", "blue"))
+        webp_original = self._read(webp_post.cover.name)
+
+        jpg_post = self._post("jpg", _image_file("foo.jpg", "JPEG", "red"))
+        jpg_variant = jpg_post._cover_variant_name("webp")
+        jpg_variant_bytes = self._read(jpg_variant)
+        png_post = self._post("png", _image_file("foo.png", "PNG", "green"))
+        png_variant = png_post._cover_variant_name("webp")
+
+        self.assertIn("webp", jpg_post.cover_formats.split(","))
+        self.assertIn("webp", png_post.cover_formats.split(","))
+        self.assertNotEqual(jpg_variant, png_variant)
+
+        # копия jpg пережила сохранение png, оригиналы на месте
+        self.assertEqual(self._read(jpg_variant), jpg_variant_bytes)
+        self.assertEqual(self._read(webp_post.cover.name), webp_original)
+        for post in (jpg_post, png_post, webp_post):
+            self.assertTrue(default_storage.exists(post.cover.name))
+
+        with Image.open(default_storage.open(jpg_variant, "rb")) as img:
+            r, g, b = img.convert("RGB").getpixel((4, 4))
+        self.assertGreater(r, 200)
+        self.assertLess(g, 60)
+
+    def test_cover_sources_point_at_own_variants(self):
+        jpg_post = self._post("jpg", _image_file("foo.jpg", "JPEG", "red"))
+        png_post = self._post("png", _image_file("foo.png", "PNG", "green"))
+
+        jpg_urls = {src["type"]: src["url"] for src in jpg_post.cover_sources}
+        png_urls = {src["type"]: src["url"] for src in png_post.cover_sources}
+        self.assertEqual(jpg_urls["image/webp"], default_storage.url(jpg_post._cover_variant_name("webp")))
+        self.assertEqual(png_urls["image/webp"], default_storage.url(png_post._cover_variant_name("webp")))
+        self.assertNotEqual(jpg_urls["image/webp"], png_urls["image/webp"])
+
+    def test_webp_original_gets_no_webp_copy(self):
+        post = self._post("webp", _image_file("foo.webp", "WEBP", "blue"))
+        self.assertNotIn("webp", post.cover_formats.split(","))
+        self.assertNotIn("image/webp", [src["type"] for src in post.cover_sources])
+
+    def test_no_cover_no_sources(self):
+        post = self._post("none", None)
+        self.assertEqual(post.cover_formats, "")
+        self.assertEqual(post.cover_sources, [])
+
+
+class ReactionCounterTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        cls.category = NewsCategory.objects.create(title="Мастерская", slug="workshop")
+        cls.post = NewsPost.objects.create(
+            category=cls.category, title="Новость", slug="news-1", status=NewsPost.Status.PUBLISHED,
+        )
+
+    def _counts(self) -> tuple:
+        return tuple(NewsPost.objects.filter(pk=self.post.pk).values_list("likes", "loves", "fires", "wows").get())
+
+    def test_created_reaction_bumps_its_counter(self):
+        NewsReaction.objects.create(post=self.post, reaction=ReactionType.LIKE, session_key="a")
+        NewsReaction.objects.create(post=self.post, reaction=ReactionType.LIKE, session_key="b")
+        NewsReaction.objects.create(post=self.post, reaction=ReactionType.WOW, session_key="a")
+        self.assertEqual(self._counts(), (2, 0, 0, 1))
+
+    def test_resave_does_not_bump_counter(self):
+        r = NewsReaction.objects.create(post=self.post, reaction=ReactionType.FIRE, session_key="a")
+        r.save()
+        self.assertEqual(self._counts(), (0, 0, 1, 0))
+
+    def test_delete_then_create_toggle(self):
+        for _ in range(3):
+            NewsReaction.objects.create(post=self.post, reaction=ReactionType.LIKE, session_key="a")
+            self.assertEqual(self._counts(), (1, 0, 0, 0))
+            NewsReaction.objects.filter(post=self.post, reaction=ReactionType.LIKE, session_key="a").delete()
+            self.assertEqual(self._counts(), (0, 0, 0, 0))
+        NewsReaction.objects.create(post=self.post, reaction=ReactionType.LIKE, session_key="a")
+        self.assertEqual(self._counts(), (1, 0, 0, 0))
+
+    def test_loaddata_does_not_count_twice(self):
+        NewsReaction.objects.create(post=self.post, reaction=ReactionType.LOVE, session_key="a")
+        post = NewsPost.objects.get(pk=self.post.pk)
+        dump = serializers.serialize("json", [post, *NewsReaction.objects.all()])
+        NewsPost.objects.filter(pk=post.pk).delete()
+
+        for obj in serializers.deserialize("json", dump):
+            obj.save()  # как loaddata: save_base(raw=True)
+        self.assertEqual(self._counts(), (0, 1, 0, 0))
+
+    def test_deleted_reaction_drops_its_counter(self):
+        r = NewsReaction.objects.create(post=self.post, reaction=ReactionType.LOVE, session_key="a")
+        r.delete()
+        self.assertEqual(self._counts(), (0, 0, 0, 0))
+
+    def test_counter_does_not_go_below_zero(self):
+        r = NewsReaction.objects.create(post=self.post, reaction=ReactionType.LIKE, session_key="a")
+        NewsPost.objects.filter(pk=self.post.pk).update(likes=0)
+        r.delete()
+        self.assertEqual(self._counts(), (0, 0, 0, 0))
+
+    def test_bulk_queryset_delete_drops_counters(self):
+        for key in ("a", "b", "c"):
+            NewsReaction.objects.create(post=self.post, reaction=ReactionType.LIKE, session_key=key)
+        NewsReaction.objects.filter(post=self.post, session_key__in=["a", "b"]).delete()
+        self.assertEqual(self._counts(), (1, 0, 0, 0))
+
+
+class ToggleReactionTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        category = NewsCategory.objects.create(title="Мастерская", slug="workshop")
+        cls.post = NewsPost.objects.create(
+            category=category, title="Новость", slug="news-1", status=NewsPost.Status.PUBLISHED,
+        )
+        cls.draft = NewsPost.objects.create(category=category, title="Черновик", slug="draft-1")
+        cls.url = reverse("news:react", args=[cls.post.slug])
+
+    def test_toggle_on_and_off(self):
+        resp = self.client.post(self.url, {"reaction": "like"})
+        self.assertEqual(resp.status_code, 200)
+        data = resp.json()
+        self.assertTrue(data["ok"])
+        self.assertEqual(data["counts"], {"like": 1, "love": 0, "fire": 0, "wow": 0})
+        self.assertEqual(data["mine"], ["like"])
+
+        data = self.client.post(self.url, {"reaction": "like"}).json()
+        self.assertEqual(data["counts"]["like"], 0)
+        self.assertEqual(data["mine"], [])
+        self.assertFalse(NewsReaction.objects.exists())
+
+    def test_reactions_are_per_session(self):
+        self.client.post(self.url, {"reaction": "fire"})
+        data = Client().post(self.url, {"reaction": "fire"}).json()
+        self.assertEqual(data["counts"]["fire"], 2)
+        self.assertEqual(data["mine"], ["fire"])
+
+    def test_logged_in_user_owns_reaction(self):
+        user = get_user_model().objects.create_user("reader", password="x")
+        self.client.force_login(user)
+        data = self.client.post(self.url, {"reaction": "wow"}).json()
+        self.assertEqual(data["mine"], ["wow"])
+        self.assertTrue(NewsReaction.objects.filter(post=self.post, user=user, session_key="").exists())
+
+    def test_bad_reaction(self):
+        resp = self.client.post(self.url, {"reaction": "meh"})
+        self.assertEqual(resp.status_code, 400)
+        self.assertEqual(resp.json(), {"ok": False, "error": "bad_reaction"})
+
+    def test_unpublished_post_is_404(self):
+        resp = self.client.post(reverse("news:react", args=[self.draft.slug]), {"reaction": "like"})
+        self.assertEqual(resp.status_code, 404)
+
+    def test_get_not_allowed(self):
+        self.assertEqual(self.client.get(self.url).status_code, 405)
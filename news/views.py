@@ -1,20 +1,22 @@
-import re
-
+from django.core.cache import cache
 from django.core.paginator import Paginator
-from django.db.models import Count
+from django.db import IntegrityError, transaction
+from django.db.models import Exists, F, OuterRef, Prefetch, Window
+from django.db.models.functions import RowNumber
 from django.http import JsonResponse, Http404
 from django.shortcuts import get_object_or_404
-from django.template.defaultfilters import linebreaks
 from django.utils import timezone
-from django.utils.html import escape
 from django.views.decorators.csrf import csrf_protect
 from django.views.decorators.http import require_POST
 from django.views.generic import TemplateView, DetailView
 
 from .models import (
+    BLOCK_CATEGORIES_CACHE_KEY,
+    REACTION_COUNTER_FIELDS,
     NewsPost,
     NewsCategory,
     NewsReaction,
+    NewsSource,
     ReactionType,
 )
 
@@ -25,79 +27,63 @@ def _get_session_key(request) -> str:
     return request.session.session_key or ""
 
 
-# поддерживаем {{img:1}}..{{img:5}} с пробелами и любым регистром
-_IMG_RE = re.compile(r"\{\{\s*img\s*:\s*([1-5])\s*\}\}", re.IGNORECASE)
-
-# URL из текста: https://... или http://...
-_URL_RE = re.compile(r"(https?://[^\s<>()\"']+)", re.IGNORECASE)
+def _reaction_owner(request) -> dict:
+    """Фильтр «чьи реакции»: пользователь или, для анонима, ключ сессии (берём один раз)."""
+    if request.user.is_authenticated:
+        return {"user": request.user}
+    return {"user__isnull": True, "session_key": _get_session_key(request)}
 
 
-def linkify_escaped_text(escaped_text: str) -> str:
+def _with_my_reactions(qs, owner: dict):
     """
-    Превращает URL в кликабельные <a>..., но ожидает,
-    что текст уже escape()-нут.
+    Добавляет к выборке новостей флаги mine_<reaction> — поставил ли реакцию
+    владелец owner (см. _reaction_owner). Счётчики уже лежат на NewsPost, так что
+    пост, счётчики и «мои» реакции приходят одним запросом.
     """
+    return qs.annotate(**{
+        f"mine_{r.value}": Exists(
+            NewsReaction.objects.filter(post=OuterRef("pk"), reaction=r.value, **owner)
+        )
+        for r in ReactionType
+    })
 
-    def repl(match):
-        url = match.group(1)
 
-        trailing = ""
-        while url and url[-1] in ".,:;!?)]}":
-            trailing = url[-1] + trailing
-            url = url[:-1]
+def _my_reactions(row) -> set:
+    """Множество реакций из флагов mine_<reaction> (объект или dict из values())."""
+    get = row.get if isinstance(row, dict) else lambda k: getattr(row, k, False)
+    return {r.value for r in ReactionType if get(f"mine_{r.value}")}
 
-        return (
-            f'<a href="{url}" target="_blank" rel="noopener">'
-            f"{url}"
-            f"</a>{trailing}"
-        )
 
-    return _URL_RE.sub(repl, escaped_text)
+# колонки карточки новости в списках: без content/rendered_parts (самые тяжёлые поля строки)
+CARD_FIELDS = (
+    "id", "slug", "title", "excerpt", "cover", "cover_formats",
+    "published_at", "created_at", "category_id",
+)
 
 
-def build_rendered_parts(post: NewsPost):
+def _load_block_categories():
     """
-    - escape() для безопасности
-    - linkify_escaped_text() для URL
-    - linebreaks() для абзацев
-    - вставка картинок по {{img:N}}
+    Категории блоков главной: по slug workshop/tech, а если таких нет —
+    первые активные. Один запрос: активных категорий единицы.
     """
-    images = {img.position: img for img in post.images.all()}
-
-    content = post.content or ""
-    parts = []
-    last = 0
-
-    for m in _IMG_RE.finditer(content):
-        start, end = m.span()
-        pos = int(m.group(1))
-
-        chunk = content[last:start]
-        if chunk.strip():
-            esc = escape(chunk)
-            esc = linkify_escaped_text(esc)
-            parts.append({"type": "html", "html": linebreaks(esc)})
-
-        img = images.get(pos)
-        if img and img.image:
-            parts.append(
-                {
-                    "type": "img",
-                    "url": img.image.url,
-                    "caption": (img.caption or "").strip(),
-                    "position": pos,
-                }
-            )
+    active = list(NewsCategory.objects.filter(is_active=True).order_by("sort_order", "title"))
+    by_slug = {c.slug: c for c in active}
+
+    workshop_cat = by_slug.get("workshop")
+    tech_cat = by_slug.get("tech")
+
+    # fallback: если таких slug нет — берём первые активные категории
+    if not workshop_cat or not tech_cat:
+        first = active[:2]
 
-        last = end
+        if not workshop_cat and len(first) >= 1:
+            workshop_cat = first[0]
 
-    tail = content[last:]
-    if tail.strip():
-        esc = escape(tail)
-        esc = linkify_escaped_text(esc)
-        parts.append({"type": "html", "html": linebreaks(esc)})
+        if not tech_cat and len(first) >= 2:
+            if workshop_cat and first[1].id != workshop_cat.id:
+                tech_cat = first[1]
 
-    return parts
+    return workshop_cat, tech_cat
 
 
 class NewsHomeView(TemplateView):
@@ -107,10 +93,11 @@ class NewsHomeView(TemplateView):
     def get_context_data(self, **kwargs):
         ctx = super().get_context_data(**kwargs)
 
+        # счётчики реакций — колонки NewsPost (likes/loves/fires/wows): карточкам
+        # они приходят в той же строке, annotate(Count(...)) по реакциям не нужен
         published_qs = (
             NewsPost.objects
-            .select_related("category")
-            .prefetch_related("images", "sources")
+            .only(*CARD_FIELDS)  # категорию, картинки и источники карточки главной не показывают
             .filter(
                 status=NewsPost.Status.PUBLISHED,
                 published_at__isnull=False,
@@ -119,46 +106,49 @@ class NewsHomeView(TemplateView):
             .order_by("-published_at", "-created_at")
         )
 
-        # попробуем найти категории по slug
-        workshop_cat = NewsCategory.objects.filter(
-            is_active=True,
-            slug="workshop"
-        ).first()
-
-        tech_cat = NewsCategory.objects.filter(
-            is_active=True,
-            slug="tech"
-        ).first()
-
-        # fallback: если таких slug нет — берём первые активные категории
-        if not workshop_cat or not tech_cat:
-            active = list(
-                NewsCategory.objects
-                .filter(is_active=True)
-                .order_by("sort_order", "title")[:2]
-            )
-
-            if not workshop_cat and len(active) >= 1:
-                workshop_cat = active[0]
-
-            if not tech_cat and len(active) >= 2:
-                if workshop_cat and active[1].id != workshop_cat.id:
-                    tech_cat = active[1]
+        # CACHES не настроен — это LocMem, свой у каждого воркера: сигнал сбрасывает
+        # кэш только в том процессе, где правили категорию, остальные догонят по TTL
+        workshop_cat, tech_cat = cache.get_or_set(
+            BLOCK_CATEGORIES_CACHE_KEY, _load_block_categories, 300
+        )
 
         ctx["workshop_category"] = workshop_cat
         ctx["tech_category"] = tech_cat
 
-        ctx["workshop_posts"] = (
-            published_qs.filter(category=workshop_cat)[:self.per_block]
-            if workshop_cat else []
+        ctx["workshop_posts"], ctx["tech_posts"] = self.get_block_posts(
+            published_qs, workshop_cat, tech_cat
         )
 
-        ctx["tech_posts"] = (
-            published_qs.filter(category=tech_cat)[:self.per_block]
-            if tech_cat else []
+        return ctx
+
+    def get_block_posts(self, published_qs, workshop_cat, tech_cat):
+        """
+        Посты обоих блоков одним запросом: ROW_NUMBER() по категории и фильтр
+        «первые per_block в каждой». В отличие от UNION с LIMIT внутри, работает
+        и на SQLite, так что запасная ветка с двумя запросами больше не нужна.
+        """
+        cats = [cat for cat in (workshop_cat, tech_cat) if cat]
+        if not cats:
+            return [], []
+
+        rows = (
+            published_qs
+            .filter(category__in=cats)
+            .annotate(rank=Window(
+                RowNumber(),
+                partition_by=F("category_id"),
+                order_by=[F("published_at").desc(), F("created_at").desc()],
+            ))
+            .filter(rank__lte=self.per_block)
         )
 
-        return ctx
+        by_cat = {cat.pk: [] for cat in cats}
+        for post in rows:
+            by_cat[post.category_id].append(post)
+        return (
+            by_cat[workshop_cat.pk] if workshop_cat else [],
+            by_cat[tech_cat.pk] if tech_cat else [],
+        )
 
 
 class NewsCategoryView(TemplateView):
@@ -180,7 +170,7 @@ class NewsCategoryView(TemplateView):
         posts_qs = (
             NewsPost.objects
             .select_related("category")
-            .prefetch_related("images", "sources")
+            .only(*CARD_FIELDS, "category__title")
             .filter(
                 status=NewsPost.Status.PUBLISHED,
                 published_at__isnull=False,
@@ -214,132 +204,86 @@ class NewsDetailView(DetailView):
     context_object_name = "post"
 
     def get_queryset(self):
-        return (
+        return _with_my_reactions(
             NewsPost.objects
-            .select_related("category")
-            .prefetch_related("sources", "images")
+            .select_related("category", "author_user")  # author_display() в шаблоне
+            # картинки текста уже в rendered_parts; источники — сразу в нужном порядке
+            .prefetch_related(Prefetch("sources", queryset=NewsSource.objects.order_by("sort_order", "id")))
             .filter(
                 status=NewsPost.Status.PUBLISHED,
                 published_at__isnull=False,
                 published_at__lte=timezone.now(),
-            )
+            ),
+            _reaction_owner(self.request),
         )
 
     def get_context_data(self, **kwargs):
         ctx = super().get_context_data(**kwargs)
         post = self.object
 
-        ctx["sources"] = list(post.sources.all().order_by("sort_order", "id"))
-        ctx["rendered_parts"] = build_rendered_parts(post)
+        ctx["sources"] = list(post.sources.all())  # из кэша prefetch, без order_by — иначе новый SELECT
+        # разметка собрана при сохранении; на лету — только для ещё не пересохранённых
+        if post.rendered_parts is None:
+            post.refresh_rendered_parts()
+        ctx["rendered_parts"] = post.rendered_parts
 
-        counts_qs = (
-            NewsReaction.objects
-            .filter(post=post)
-            .values("reaction")
-            .annotate(c=Count("id"))
-        )
-        counts = {row["reaction"]: row["c"] for row in counts_qs}
-
-        ctx["count_like"] = counts.get("like", 0)
-        ctx["count_love"] = counts.get("love", 0)
-        ctx["count_fire"] = counts.get("fire", 0)
-        ctx["count_wow"] = counts.get("wow", 0)
-
-        if self.request.user.is_authenticated:
-            mine = set(
-                NewsReaction.objects
-                .filter(post=post, user=self.request.user)
-                .values_list("reaction", flat=True)
-            )
-        else:
-            sk = _get_session_key(self.request)
-            mine = set(
-                NewsReaction.objects
-                .filter(post=post, user__isnull=True, session_key=sk)
-                .values_list("reaction", flat=True)
-            )
+        # счётчики денормализованы на NewsPost — без GROUP BY по реакциям
+        for reaction, field in REACTION_COUNTER_FIELDS.items():
+            ctx[f"count_{reaction.value}"] = getattr(post, field)
 
-        ctx["my_reactions"] = mine
+        ctx["my_reactions"] = _my_reactions(post)
         return ctx
 
 
 @require_POST
 @csrf_protect
 def toggle_reaction(request, slug: str):
-    post = get_object_or_404(
-        NewsPost,
-        slug=slug,
-        status=NewsPost.Status.PUBLISHED,
-        published_at__isnull=False,
-        published_at__lte=timezone.now(),
-    )
-
     reaction = (request.POST.get("reaction") or "").strip()
     allowed = {r.value for r in ReactionType}
     if reaction not in allowed:
         return JsonResponse({"ok": False, "error": "bad_reaction"}, status=400)
 
-    if request.user.is_authenticated:
-        lookup = {"post": post, "reaction": reaction, "user": request.user}
-        existing = NewsReaction.objects.filter(**lookup)
-        if existing.exists():
-            existing.delete()
-        else:
-            NewsReaction.objects.create(
-                post=post,
-                reaction=reaction,
-                user=request.user,
-                session_key="",
-            )
-    else:
-        sk = _get_session_key(request)
-        lookup = {
-            "post": post,
-            "reaction": reaction,
-            "user__isnull": True,
-            "session_key": sk,
-        }
-        existing = NewsReaction.objects.filter(**lookup)
-        if existing.exists():
-            existing.delete()
-        else:
-            NewsReaction.objects.create(
-                post=post,
-                reaction=reaction,
-                user=None,
-                session_key=sk,
-            )
-
-    counts_qs = (
-        NewsReaction.objects
-        .filter(post=post)
-        .values("reaction")
-        .annotate(c=Count("id"))
+    # от поста нужен только pk — content/rendered_parts не тянем
+    post = get_object_or_404(
+        NewsPost.objects.only("id"),
+        slug=slug,
+        status=NewsPost.Status.PUBLISHED,
+        published_at__isnull=False,
+        published_at__lte=timezone.now(),
     )
-    counts = {row["reaction"]: row["c"] for row in counts_qs}
 
-    if request.user.is_authenticated:
-        mine = set(
-            NewsReaction.objects
-            .filter(post=post, user=request.user)
-            .values_list("reaction", flat=True)
-        )
-    else:
-        sk = _get_session_key(request)
-        mine = set(
-            NewsReaction.objects
-            .filter(post=post, user__isnull=True, session_key=sk)
-            .values_list("reaction", flat=True)
-        )
+    owner = _reaction_owner(request)
+    create_kwargs = {"user": owner.get("user"), "session_key": owner.get("session_key", "")}
+
+    # Строка реакции, счётчик на NewsPost (его двигают сигналы NewsReaction)
+    # и ответ клиенту — в одной транзакции: счётчики не расходятся с реакциями,
+    # а в ответ уходят значения ровно после этого клика.
+    with transaction.atomic():
+        # Без exists(): число удалённых строк и есть ответ «была ли реакция».
+        # Уникальный constraint страхует от двойного клика: второй INSERT
+        # конфликтует, реакция уже стоит.
+        deleted, _ = NewsReaction.objects.filter(post=post, reaction=reaction, **owner).delete()
+        if not deleted:
+            try:
+                with transaction.atomic():
+                    NewsReaction.objects.create(post=post, reaction=reaction, **create_kwargs)
+            except IntegrityError:
+                pass
+
+        # свежие счётчики и «мои» — одним запросом
+        counts = (
+            _with_my_reactions(NewsPost.objects.filter(pk=post.pk), owner)
+            .values(*REACTION_COUNTER_FIELDS.values(), *(f"mine_{r.value}" for r in ReactionType))
+            .first()
+        ) or {}
+    mine = _my_reactions(counts)
 
     return JsonResponse(
         {
             "ok": True,
             "counts": {
-                "like": counts.get("like", 0),
-                "love": counts.get("love", 0),
-                "fire": counts.get("fire", 0),
-                "wow": counts.get("wow", 0),
+                reaction.value: counts.get(field, 0)
+                for reaction, field in REACTION_COUNTER_FIELDS.items()
             },
             "mine": list(mine),
         }
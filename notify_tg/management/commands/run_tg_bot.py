@@ -1,16 +1,28 @@
 # notify_tg/management/commands/run_tg_bot.py
+"""
+Telegram-бот реферальной программы: подтверждение телефона, выдача кода, баланс и отчёт.
+
+Бот — асинхронная обвязка над ORM и Bot API, время уходит на ожидание Postgres
+и api.telegram.org, а не на вычисления. Ускорять его — число запросов (кэш партнёра,
+агрегаты, values_list), пул соединений и параллельность; Numba/Cython/C-расширения
+здесь ничего не дадут.
+"""
 from __future__ import annotations
 
+import functools
 import logging
-import random
+import re
+import secrets
 import string
+import time
+from concurrent.futures import ThreadPoolExecutor
 from decimal import Decimal
 
 from asgiref.sync import sync_to_async
 from django.conf import settings
 from django.core.management.base import BaseCommand
-from django.db import IntegrityError, transaction
-from django.db.models import Sum
+from django.db import IntegrityError, close_old_connections, transaction
+from django.db.models import Count, Q, Sum
 
 from telegram import Update, ReplyKeyboardMarkup, KeyboardButton
 from telegram.ext import (
@@ -25,9 +37,23 @@ logger = logging.getLogger(__name__)
 # =========================
 # Utils
 # =========================
+# алфавит кодов собираем один раз; secrets — CSPRNG без общего состояния Mersenne Twister
+_CODE_ALPHABET = string.ascii_uppercase + string.digits
+
+
+def _random_code(length: int) -> str:
+    return "".join([secrets.choice(_CODE_ALPHABET) for _ in range(length)])
+
+
+# 12 символов из 36 (~62 бита) у временного кода и 8 (~41 бит) у настоящего:
+# коллизия почти невозможна, поэтому одна попытка и один повтор на всякий случай
+# вместо 50 INSERT-ов с откатом транзакции. Повторяем только коллизию кода: конфликт
+# по chat_id разрешается перечитыванием существующей привязки
+_CODE_ATTEMPTS = 2
+
+
 def gen_ref_code(length: int = 8) -> str:
-    alphabet = string.ascii_uppercase + string.digits
-    return "".join(random.choice(alphabet) for _ in range(length))
+    return _random_code(length)
 
 
 def gen_pending_code() -> str:
@@ -37,13 +63,20 @@ def gen_pending_code() -> str:
     ВАЖНО: в проде Postgres строго валидирует длину поля code.
     Судя по ошибке у тебя code = varchar(16), поэтому делаем <= 16 символов.
     """
-    alphabet = string.ascii_uppercase + string.digits
     # 4 ("PEND") + 12 = 16
-    return "PEND" + "".join(random.choice(alphabet) for _ in range(12))
+    return "PEND" + _random_code(12)
+
+
+# всё, кроме ASCII-цифр: одна замена на C вместо генератора по символам
+_NON_DIGITS_RE = re.compile(r"[^0-9]+")
+
+
+def only_digits(s: str) -> str:
+    return _NON_DIGITS_RE.sub("", s or "")
 
 
 def norm_phone(s: str) -> str:
-    digits = "".join(ch for ch in (s or "") if ch.isdigit())
+    digits = only_digits(s)
     return digits[-9:] if len(digits) >= 9 else digits
 
 
@@ -56,21 +89,45 @@ def partner_has_real_code(partner: ReferralPartner) -> bool:
     return bool(partner.code) and not partner.code.startswith("PEND")
 
 
+_ZERO_MONEY = "0.00"
+_D_ZERO = Decimal("0")
+
+
 def fmt_money(x: Decimal | int | None) -> str:
+    # нули — самый частый случай в балансе (ожидает/использовано и т.п.): готовая строка
+    if x is None or x == _D_ZERO:
+        return _ZERO_MONEY
+    # суммы из агрегатов и DecimalField уже Decimal — форматируем без конструктора
+    if isinstance(x, Decimal):
+        return f"{x:.2f}"
     try:
-        return f"{Decimal(x or 0):.2f}"
+        return f"{Decimal(x):.2f}"
     except Exception:
-        return "0.00"
+        return _ZERO_MONEY
 
 
 def fmt_date(dt) -> str:
+    if dt is None:
+        return ""
     try:
-        return dt.strftime("%d.%m.%Y %H:%M")
+        return f"{dt:%d.%m.%Y %H:%M}"
     except Exception:
         return ""
 
 
+# коды статусов ReferralRedemption -> короткая подпись: в отчёте приходят именно коды
+_STATUS_SHORT = {
+    "pending": "⏳ ожидает",
+    "accrued": "✅ начислено",
+    "paid": "🔻 использовано",
+}
+
+
 def shorten_status_ru(status_display: str) -> str:
+    short = _STATUS_SHORT.get(status_display)
+    if short:
+        return short
+    # подписи get_status_display() и прочий текст — по вхождению
     s = (status_display or "").strip().lower()
     if "ожида" in s or "pending" in s:
         return "⏳ ожидает"
@@ -92,28 +149,31 @@ BTN_RULES = "Как работает?"
 BTN_SEND_PHONE = "Подтвердить номер"
 
 
-def reply_kb(full: bool) -> ReplyKeyboardMarkup:
-    if not full:
-        return ReplyKeyboardMarkup(
-            [
-                [KeyboardButton(BTN_SEND_PHONE, request_contact=True)],
-                [KeyboardButton(BTN_RULES), KeyboardButton(BTN_HELP)],
-            ],
-            resize_keyboard=True,
-            one_time_keyboard=False,
-            is_persistent=True,
-        )
+# Клавиатуры не меняются за жизнь процесса (объекты PTB неизменяемы) — собираем один раз
+_KB_MIN = ReplyKeyboardMarkup(
+    [
+        [KeyboardButton(BTN_SEND_PHONE, request_contact=True)],
+        [KeyboardButton(BTN_RULES), KeyboardButton(BTN_HELP)],
+    ],
+    resize_keyboard=True,
+    one_time_keyboard=False,
+    is_persistent=True,
+)
 
-    return ReplyKeyboardMarkup(
-        [
-            [KeyboardButton(BTN_MY_CODE), KeyboardButton(BTN_BALANCE)],
-            [KeyboardButton(BTN_REPORT), KeyboardButton(BTN_RULES)],
-            [KeyboardButton(BTN_HELP), KeyboardButton(BTN_SEND_PHONE, request_contact=True)],
-        ],
-        resize_keyboard=True,
-        one_time_keyboard=False,
-        is_persistent=True,
-    )
+_KB_FULL = ReplyKeyboardMarkup(
+    [
+        [KeyboardButton(BTN_MY_CODE), KeyboardButton(BTN_BALANCE)],
+        [KeyboardButton(BTN_REPORT), KeyboardButton(BTN_RULES)],
+        [KeyboardButton(BTN_HELP), KeyboardButton(BTN_SEND_PHONE, request_contact=True)],
+    ],
+    resize_keyboard=True,
+    one_time_keyboard=False,
+    is_persistent=True,
+)
+
+
+def reply_kb(full: bool) -> ReplyKeyboardMarkup:
+    return _KB_FULL if full else _KB_MIN
 
 
 async def _reply(update: Update, text: str, full_keyboard: bool, parse_mode: str | None = None):
@@ -130,55 +190,187 @@ async def _reply(update: Update, text: str, full_keyboard: bool, parse_mode: str
 # =========================
 # Text blocks
 # =========================
+# текст правил не меняется — собираем один раз при импорте, на вызов остаётся только код
+_RULES_TEXT = (
+    "📌 <b>Реферальная программа</b>\n\n"
+    "Как это работает:\n"
+    "1) Подтвердите номер телефона в боте\n"
+    "2) Получите личный реферальный код\n"
+    "3) Делитесь кодом с друзьями/знакомыми\n\n"
+    "🛠 <b>Где оформляют ремонт</b>\n"
+    "• На сайте <code>tehsfera.by</code>\n"
+    "• При оформлении заявки на ремонт клиент вводит ваш код в поле «Промокод / Реферальный код»\n\n"
+    "✅ <b>Что получает клиент</b>\n"
+    "• <b>-5%</b> скидка от суммы ремонта при вводе кода\n\n"
+    "✅ <b>Что получаете вы</b>\n"
+    "• <b>+5%</b> в накопления после выполненного ремонта (статус <b>done</b>)\n"
+    "• Накопления можно использовать на ваш будущий ремонт — хоть до <b>0 BYN</b>"
+)
+
+
+@functools.lru_cache(maxsize=2048)  # текст зависит только от кода: одна строка на партнёра
 def rules_text(with_code: str | None = None) -> str:
-    code_line = f"\n\n🎟 Ваш код: <b>{with_code}</b>" if with_code else ""
-    return (
-        "📌 <b>Реферальная программа</b>\n\n"
-        "Как это работает:\n"
-        "1) Подтвердите номер телефона в боте\n"
-        "2) Получите личный реферальный код\n"
-        "3) Делитесь кодом с друзьями/знакомыми\n\n"
-        "🛠 <b>Где оформляют ремонт</b>\n"
-        "• На сайте <code>tehsfera.by</code>\n"
-        "• При оформлении заявки на ремонт клиент вводит ваш код в поле «Промокод / Реферальный код»\n\n"
-        "✅ <b>Что получает клиент</b>\n"
-        "• <b>-5%</b> скидка от суммы ремонта при вводе кода\n\n"
-        "✅ <b>Что получаете вы</b>\n"
-        "• <b>+5%</b> в накопления после выполненного ремонта (статус <b>done</b>)\n"
-        "• Накопления можно использовать на ваш будущий ремонт — хоть до <b>0 BYN</b>"
-        f"{code_line}"
-    )
+    if not with_code:
+        return _RULES_TEXT
+    return f"{_RULES_TEXT}\n\n🎟 Ваш код: <b>{with_code}</b>"
 
 
 # =========================
 # DB helpers
 # =========================
-@sync_to_async
-def db_get_partner_by_code(code: str) -> ReferralPartner | None:
-    return ReferralPartner.objects.filter(code__iexact=code).first()
+# Свой пул потоков вместо одного общего (thread_sensitive=True): запросы из разных
+# чатов не ждут друг друга. Размер — под бюджет соединений Postgres (по одному на поток).
+_db_executor = ThreadPoolExecutor(
+    max_workers=getattr(settings, "TELEGRAM_DB_WORKERS", 4),
+    thread_name_prefix="tg-db",
+)
+
+
+def db_async(fn):
+    """
+    Синхронный хелпер БД -> корутина на _db_executor. У каждого потока пула своё
+    соединение, живущее CONN_MAX_AGE. Транзакция должна целиком укладываться в
+    один хелпер: между await-ами следующий вызов может уйти в другой поток,
+    т.е. в другое соединение.
+    """
+    @functools.wraps(fn)
+    def run(*args, **kwargs):
+        # как на границах веб-запроса: протухшие/сломанные соединения закрываем (CONN_MAX_AGE)
+        close_old_connections()
+        try:
+            return fn(*args, **kwargs)
+        finally:
+            close_old_connections()
 
+    return sync_to_async(run, thread_sensitive=False, executor=_db_executor)
 
-@sync_to_async
-def db_get_partner_by_chat(chat_id: int) -> ReferralPartner | None:
+
+# Партнёр по chat_id нужен на каждое нажатие кнопки. Бот работает одним процессом,
+# поэтому держим его в памяти с TTL: правки из бота сбрасывают запись сразу
+# (_forget_partner), правки из админки бот увидит не позже чем через TTL.
+PARTNER_CACHE_TTL = 300
+PARTNER_CACHE_MAX = 4096  # потолок памяти: дольше всех не обновлявшиеся чаты вытесняются
+_partner_cache: dict[int, tuple[float, ReferralPartner]] = {}
+
+
+def _forget_partner(chat_id: int | None = None, partner_id: int | None = None) -> None:
+    if chat_id is not None:
+        _partner_cache.pop(chat_id, None)
+    if partner_id is not None:
+        # list() снимком: хелперы БД работают в нескольких потоках (_db_executor)
+        for cid in [cid for cid, (_, p) in list(_partner_cache.items()) if p.id == partner_id]:
+            _partner_cache.pop(cid, None)
+
+
+def _remember_partner(chat_id: int, partner: ReferralPartner) -> None:
+    # pop + вставка переносит чат в конец dict; в начале остаются самые старые записи
+    _partner_cache.pop(chat_id, None)
+    _partner_cache[chat_id] = (time.monotonic() + PARTNER_CACHE_TTL, partner)
+    while len(_partner_cache) > PARTNER_CACHE_MAX:
+        try:
+            _partner_cache.pop(next(iter(_partner_cache)), None)
+        except (StopIteration, RuntimeError):  # словарь меняют и другие потоки пула
+            break
+
+
+def _cached_partner(chat_id: int) -> ReferralPartner | None:
+    cached = _partner_cache.get(chat_id)
+    if cached and cached[0] > time.monotonic():
+        return cached[1]
+    return None
+
+
+# Попадание в кэш отдаём прямо в event loop: без перехода в _db_executor и обратно.
+# Нативные aget()/afirst() Django тут не помогли бы — это тот же sync_to_async,
+# только на общем однопоточном исполнителе, т.е. минус параллельность пула.
+async def db_get_partner_by_chat(chat_id: int) -> ReferralPartner | None:
+    return _cached_partner(chat_id) or await _db_load_partner_by_chat(chat_id)
+
+
+@db_async
+def _db_load_partner_by_chat(chat_id: int) -> ReferralPartner | None:
     pt = PartnerTelegram.objects.select_related("partner").filter(
         chat_id=chat_id, is_active=True
     ).first()
-    return pt.partner if pt else None
+    if not pt:
+        _partner_cache.pop(chat_id, None)
+        return None
+    _remember_partner(chat_id, pt.partner)
+    return pt.partner
+
+
+# code -> id партнёра: iexact по коду дороже выборки по PK. Храним только id,
+# а совпадение кода сверяем на свежей строке — устаревших полей не бывает.
+_partner_by_code_cache: dict[str, tuple[float, int]] = {}
+
+
+@db_async
+def db_get_partner_by_code(code: str) -> ReferralPartner | None:
+    return _partner_by_code(code)
 
 
-@sync_to_async
+def _partner_by_code(code: str) -> ReferralPartner | None:
+    key = code.strip().upper()
+    cached = _partner_by_code_cache.get(key)
+    if cached and cached[0] > time.monotonic():
+        partner = ReferralPartner.objects.filter(pk=cached[1]).first()
+        if partner and partner.code.upper() == key:
+            return partner
+        _partner_by_code_cache.pop(key, None)
+
+    partner = ReferralPartner.objects.filter(code__iexact=code).first()
+    if partner:
+        _partner_by_code_cache[key] = (time.monotonic() + PARTNER_CACHE_TTL, partner.id)
+    return partner
+
+
+@db_async
 def db_link_partner_chat(partner_id: int, chat_id: int):
-    partner = ReferralPartner.objects.get(id=partner_id)
-    PartnerTelegram.objects.filter(chat_id=chat_id).exclude(partner_id=partner_id).delete()
+    return _link_partner_chat(ReferralPartner.objects.get(id=partner_id), chat_id)
+
+
+@db_async
+def db_bootstrap_from_code(code: str, chat_id: int) -> ReferralPartner | None:
+    """/start <код>: поиск партнёра и привязка чата — одна транзакция и один переход в пул."""
+    with transaction.atomic():
+        partner = _partner_by_code(code)
+        if partner:
+            _link_partner_chat(partner, chat_id)
+    return partner
+
+
+def _link_partner_chat(partner: ReferralPartner, chat_id: int):
+    partner_id = partner.id
+    # чат отвязываем от чужого партнёра только если он и правда к нему привязан:
+    # при повторной привязке к тому же партнёру DELETE (и запись в WAL) не нужен
+    linked_to = (PartnerTelegram.objects
+                 .filter(chat_id=chat_id)
+                 .values_list("partner_id", flat=True)
+                 .first())
+    if linked_to is not None and linked_to != partner_id:
+        PartnerTelegram.objects.filter(chat_id=chat_id).exclude(partner_id=partner_id).delete()
     obj, created = PartnerTelegram.objects.update_or_create(
         partner=partner,
         defaults={"chat_id": chat_id, "is_active": True},
     )
+    _forget_partner(chat_id=chat_id, partner_id=partner_id)
     return created, obj
 
 
-@sync_to_async
-def db_get_or_create_partner_for_chat(
+async def db_get_or_create_partner_for_chat(
+    chat_id: int,
+    tg_username: str | None,
+    full_name: str | None,
+) -> tuple[ReferralPartner, bool]:
+    # повторный /start от привязанного чата — из того же кэша, что и кнопки, без запроса
+    partner = _cached_partner(chat_id)
+    if partner:
+        return partner, False
+    return await _db_get_or_create_partner_for_chat(chat_id, tg_username, full_name)
+
+
+@db_async
+def _db_get_or_create_partner_for_chat(
     chat_id: int,
     tg_username: str | None,
     full_name: str | None,
@@ -192,12 +384,13 @@ def db_get_or_create_partner_for_chat(
           .filter(chat_id=chat_id, is_active=True)
           .first())
     if pt:
+        _remember_partner(chat_id, pt.partner)
         return pt.partner, False
 
     name = (full_name or "").strip() or f"TG user {chat_id}"
     contact = f"@{tg_username}" if tg_username else ""
 
-    for _ in range(50):
+    for _ in range(_CODE_ATTEMPTS):
         pending_code = gen_pending_code()
         try:
             with transaction.atomic():
@@ -211,37 +404,69 @@ def db_get_or_create_partner_for_chat(
                     chat_id=chat_id,
                     is_active=True,
                 )
+            _remember_partner(chat_id, partner)
             return partner, True
         except IntegrityError:
-            continue
+            # конфликт по chat_id (привязку успели создать параллельно) — повтор не поможет,
+            # отдаём существующую строку; повторяем только при коллизии кода
+            pt = (PartnerTelegram.objects
+                  .select_related("partner")
+                  .filter(chat_id=chat_id)
+                  .first())
+            if pt is None:
+                continue
+            if not pt.is_active:
+                raise RuntimeError(f"TG-привязка чата {chat_id} отключена")
+            _remember_partner(chat_id, pt.partner)
+            return pt.partner, False
 
     raise RuntimeError("Не удалось создать временный код")
 
 
-@sync_to_async
-def db_set_partner_phone(partner_id: int, phone: str):
-    digits = "".join(ch for ch in (phone or "") if ch.isdigit())
-    ReferralPartner.objects.filter(id=partner_id).update(contact=digits)
+@db_async
+def db_set_phone_and_assign_code(partner_id: int, phone: str) -> str:
+    """
+    Телефон и настоящий реф-код (если код ещё PEND) — один заход в пул БД и один UPDATE
+    в одной транзакции: код не выдаётся, если телефон не записался.
+    """
+    digits = only_digits(phone)
+    for _ in range(_CODE_ATTEMPTS):
+        try:
+            with transaction.atomic():
+                p = ReferralPartner.objects.select_for_update().only("id", "code", "contact").get(id=partner_id)
+                p.contact = digits
+                if not partner_has_real_code(p):
+                    p.code = gen_ref_code(8)
+                p.save(update_fields=["contact", "code"])
+            _forget_partner(partner_id=partner_id)
+            return p.code
+        except IntegrityError:
+            # коллизия кода: телефон откатился вместе с ним — повторяем оба
+            continue
 
+    raise RuntimeError("Не удалось сгенерировать уникальный реферальный код")
 
-@sync_to_async
+
+@db_async
 def db_assign_real_code_if_needed(partner_id: int) -> str:
     """
     Если у партнёра временный PEND-код — генерируем настоящий реф-код.
     """
-    partner = ReferralPartner.objects.get(id=partner_id)
-    if partner_has_real_code(partner):
-        return partner.code
+    # быстрый путь: одна колонка, без блокировки и транзакции
+    current = ReferralPartner.objects.filter(id=partner_id).values_list("code", flat=True).first()
+    if current and not current.startswith("PEND"):
+        return current
 
-    for _ in range(50):
+    for _ in range(_CODE_ATTEMPTS):
         code = gen_ref_code(8)
         try:
             with transaction.atomic():
-                p = ReferralPartner.objects.select_for_update().get(id=partner_id)
+                p = ReferralPartner.objects.select_for_update().only("id", "code").get(id=partner_id)
                 if partner_has_real_code(p):
                     return p.code
                 p.code = code
                 p.save(update_fields=["code"])
+            _forget_partner(partner_id=partner_id)
             return code
         except IntegrityError:
             continue
@@ -249,18 +474,22 @@ def db_assign_real_code_if_needed(partner_id: int) -> str:
     raise RuntimeError("Не удалось сгенерировать уникальный реферальный код")
 
 
-@sync_to_async
+@db_async
 def db_calc_balance(partner_id: int) -> dict:
-    qs = ReferralRedemption.objects.filter(partner_id=partner_id)
-
-    earned_pending = qs.filter(status="pending", commission_amount__gt=0).aggregate(s=Sum("commission_amount"))["s"] or Decimal("0.00")
-    earned_accrued = qs.filter(status="accrued", commission_amount__gt=0).aggregate(s=Sum("commission_amount"))["s"] or Decimal("0.00")
-
-    spent = qs.filter(commission_amount__lt=0).aggregate(s=Sum("commission_amount"))["s"] or Decimal("0.00")  # отрицательное
-    spent_abs = -Decimal(spent)
+    # всё одним запросом: агрегаты с FILTER вместо пяти отдельных SELECT
+    agg = ReferralRedemption.objects.filter(partner_id=partner_id).aggregate(
+        earned_pending=Sum("commission_amount", filter=Q(status="pending", commission_amount__gt=0)),
+        earned_accrued=Sum("commission_amount", filter=Q(status="accrued", commission_amount__gt=0)),
+        spent=Sum("commission_amount", filter=Q(commission_amount__lt=0)),  # отрицательное
+        uses=Count("id", filter=Q(commission_amount__gt=0)),
+        total_discount=Sum("discount_amount", filter=Q(commission_amount__gt=0)),
+    )
 
-    uses = qs.filter(commission_amount__gt=0).count()
-    total_discount = qs.filter(commission_amount__gt=0).aggregate(s=Sum("discount_amount"))["s"] or Decimal("0.00")
+    earned_pending = agg["earned_pending"] or Decimal("0.00")
+    earned_accrued = agg["earned_accrued"] or Decimal("0.00")
+    spent_abs = -Decimal(agg["spent"] or Decimal("0.00"))
+    uses = agg["uses"]
+    total_discount = agg["total_discount"] or Decimal("0.00")
 
     earned_pending = Decimal(earned_pending).quantize(Decimal("0.01"))
     earned_accrued = Decimal(earned_accrued).quantize(Decimal("0.01"))
@@ -281,25 +510,45 @@ def db_calc_balance(partner_id: int) -> dict:
     }
 
 
-@sync_to_async
+@db_async
 def db_last_ops(partner_id: int, limit: int = 12) -> list[dict]:
-    qs = (ReferralRedemption.objects
-          .select_related("appointment")
-          .filter(partner_id=partner_id)
-          .order_by("-created_at")[:limit])
+    # values(): нужны 4 колонки, модели (и JOIN на appointment — хватает appointment_id) не строим
+    rows = (ReferralRedemption.objects
+            .filter(partner_id=partner_id)
+            .order_by("-created_at")
+            .values_list("created_at", "appointment_id", "commission_amount", "status")[:limit])
     res = []
-    for r in qs:
-        is_spend = r.commission_amount < 0
+    for created_at, appointment_id, amount, status in rows:
+        is_spend = amount < 0
         res.append({
-            "created_at": r.created_at,
-            "appointment_id": r.appointment_id,
+            "created_at": created_at,
+            "appointment_id": appointment_id,
             "kind": "🔻 Списание" if is_spend else "➕ Начисление",
-            "amount": (-r.commission_amount if is_spend else r.commission_amount),
-            "status": r.get_status_display(),
+            "amount": (-amount if is_spend else amount),
+            "status": shorten_status_ru(status),  # код статуса -> подпись одним dict-поиском
         })
     return res
 
 
+# =========================
+# Тексты ответов
+# =========================
+# статичные части собраны один раз при импорте; на вызов подставляется только код
+_SITE_HINT = "Ремонт оформляют на сайте <code>tehsfera.by</code> — при оформлении заявки вводят код."
+_RULES_HINT = "Нажмите «Как работает?», чтобы посмотреть правила."
+
+_MSG_PHONE_FIRST = (
+    "✅ Вам будет присвоен реферальный код, но сначала подтвердите номер телефона.\n"
+    "Нажмите кнопку «Подтвердить номер»."
+)
+_MSG_CABINET = ("✅ Кабинет активен.\n🎟 Ваш код: <b>{code}</b>\n\n" + _SITE_HINT).format
+_MSG_READY = ("✅ Готово!\n🎟 Ваш реферальный код: <b>{code}</b>\n\n" + _SITE_HINT + "\n" + _RULES_HINT).format
+_MSG_PHONE_OK = (
+    "✅ Номер подтверждён!\n\n🎟 Ваш реферальный код: <b>{code}</b>\n\n" + _SITE_HINT + "\n" + _RULES_HINT
+).format
+_MSG_MY_CODE = ("🎟 <b>Ваш реферальный код</b>\n<code>{code}</code>\n\n" + _SITE_HINT).format
+
+
 # =========================
 # Handlers
 # =========================
@@ -312,26 +561,13 @@ async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
 
     code_arg = (context.args[0].strip() if context.args else "")
     if code_arg:
-        partner = await db_get_partner_by_code(code_arg)
+        partner = await db_bootstrap_from_code(code_arg, chat_id)
         if partner:
-            await db_link_partner_chat(partner.id, chat_id)
             if not partner_has_phone(partner):
-                await _reply(
-                    update,
-                    "✅ Вам будет присвоен реферальный код, но сначала подтвердите номер телефона.\n"
-                    "Нажмите кнопку «Подтвердить номер».",
-                    full_keyboard=False,
-                )
+                await _reply(update, _MSG_PHONE_FIRST, full_keyboard=False)
                 return
 
-            await _reply(
-                update,
-                "✅ Кабинет активен.\n"
-                f"🎟 Ваш код: <b>{partner.code}</b>\n\n"
-                "Ремонт оформляют на сайте <code>tehsfera.by</code> — при оформлении заявки вводят код.",
-                full_keyboard=True,
-                parse_mode="HTML",
-            )
+            await _reply(update, _MSG_CABINET(code=partner.code), full_keyboard=True, parse_mode="HTML")
             return
 
     partner, _ = await db_get_or_create_partner_for_chat(
@@ -341,25 +577,22 @@ async def cmd_start(update: Update, context: ContextTypes.DEFAULT_TYPE):
     )
 
     if not partner_has_phone(partner):
-        await _reply(
-            update,
-            "✅ Вам будет присвоен реферальный код, но сначала подтвердите номер телефона.\n"
-            "Нажмите кнопку «Подтвердить номер».",
-            full_keyboard=False,
-        )
+        await _reply(update, _MSG_PHONE_FIRST, full_keyboard=False)
         return
 
     code = await db_assign_real_code_if_needed(partner.id) if not partner_has_real_code(partner) else partner.code
 
-    await _reply(
-        update,
-        "✅ Готово!\n"
-        f"🎟 Ваш реферальный код: <b>{code}</b>\n\n"
-        "Ремонт оформляют на сайте <code>tehsfera.by</code> — при оформлении заявки вводят код.\n"
-        "Нажмите «Как работает?», чтобы посмотреть правила.",
-        full_keyboard=True,
-        parse_mode="HTML",
-    )
+    await _reply(update, _MSG_READY(code=code), full_keyboard=True, parse_mode="HTML")
+
+
+# подписи кнопок — константы, справку собираем один раз при импорте
+_HELP_TEXT = (
+    "📍 Разделы:\n"
+    f"• «{BTN_MY_CODE}» — ваш код\n"
+    f"• «{BTN_BALANCE}» — накопления и сколько доступно\n"
+    f"• «{BTN_REPORT}» — операции (начисления/списания)\n"
+    f"• «{BTN_RULES}» — подробные правила\n"
+)
 
 
 async def cmd_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -370,15 +603,7 @@ async def cmd_help(update: Update, context: ContextTypes.DEFAULT_TYPE):
         await _reply(update, "ℹ️ Сначала подтвердите номер телефона кнопкой «Подтвердить номер».", full_keyboard=False)
         return
 
-    await _reply(
-        update,
-        "📍 Разделы:\n"
-        f"• «{BTN_MY_CODE}» — ваш код\n"
-        f"• «{BTN_BALANCE}» — накопления и сколько доступно\n"
-        f"• «{BTN_REPORT}» — операции (начисления/списания)\n"
-        f"• «{BTN_RULES}» — подробные правила\n",
-        full_keyboard=True,
-    )
+    await _reply(update, _HELP_TEXT, full_keyboard=True)
 
 
 async def cmd_rules(update: Update, context: ContextTypes.DEFAULT_TYPE):
@@ -409,12 +634,7 @@ async def cmd_link(update: Update, context: ContextTypes.DEFAULT_TYPE):
     await db_link_partner_chat(partner.id, update.effective_chat.id)
 
     if not partner_has_phone(partner):
-        await _reply(
-            update,
-            "✅ Вам будет присвоен реферальный код, но сначала подтвердите номер телефона.\n"
-            "Нажмите кнопку «Подтвердить номер».",
-            full_keyboard=False,
-        )
+        await _reply(update, _MSG_PHONE_FIRST, full_keyboard=False)
         return
 
     await _reply(update, f"✅ Чат привязан. Ваш код: <b>{partner.code}</b>", full_keyboard=True, parse_mode="HTML")
@@ -440,23 +660,93 @@ async def on_contact(update: Update, context: ContextTypes.DEFAULT_TYPE):
         full_name = " ".join([x for x in [(user.first_name if user else ""), (user.last_name if user else "")] if x]).strip()
         partner, _ = await db_get_or_create_partner_for_chat(chat_id, tg_username or None, full_name or None)
 
-    await db_set_partner_phone(partner.id, phone)
-    real_code = await db_assign_real_code_if_needed(partner.id)
-
-    await _reply(
-        update,
-        "✅ Номер подтверждён!\n\n"
-        f"🎟 Ваш реферальный код: <b>{real_code}</b>\n\n"
-        "Ремонт оформляют на сайте <code>tehsfera.by</code> — при оформлении заявки вводят код.\n"
-        "Нажмите «Как работает?», чтобы посмотреть правила.",
-        full_keyboard=True,
-        parse_mode="HTML",
+    real_code = await db_set_phone_and_assign_code(partner.id, phone)
+
+    await _reply(update, _MSG_PHONE_OK(code=real_code), full_keyboard=True, parse_mode="HTML")
+
+
+async def _on_my_code(update: Update, context: ContextTypes.DEFAULT_TYPE, partner: ReferralPartner):
+    await _reply(update, _MSG_MY_CODE(code=partner.code), full_keyboard=True, parse_mode="HTML")
+
+
+async def _on_balance(update: Update, context: ContextTypes.DEFAULT_TYPE, partner: ReferralPartner):
+    b = await db_calc_balance(partner.id)
+    text_out = (
+        "💰 <b>Баланс накоплений</b>\n"
+        f"👤 {partner.name}\n"
+        f"🎟 Код: <code>{partner.code}</code>\n\n"
+        "📌 Сводка:\n"
+        f"• Использований кода: <b>{b['uses']}</b>\n"
+        f"• Начислено (выполнено): <b>{fmt_money(b['earned_accrued'])}</b> BYN\n"
+        f"• Ожидает: <b>{fmt_money(b['earned_pending'])}</b> BYN\n"
+        f"• Использовано: <b>{fmt_money(b['spent'])}</b> BYN\n\n"
+        f"✅ <b>Доступно сейчас:</b> <b>{fmt_money(b['available'])}</b> BYN\n"
+        f"🔮 <b>Потенциал:</b> {fmt_money(b['potential'])} BYN\n\n"
+        f"🎁 Скидок клиентам: {fmt_money(b['total_discount'])} BYN"
+    )
+    await _reply(update, text_out, full_keyboard=True, parse_mode="HTML")
+
+
+# строка отчёта; шаблон разобран один раз, на операцию — один вызов format
+_REPORT_ROW = "• <b>#{aid}</b>  {kind}  <b>{amount}</b> BYN\n  {date} • {status}".format
+
+
+async def _on_report(update: Update, context: ContextTypes.DEFAULT_TYPE, partner: ReferralPartner):
+    ops = await db_last_ops(partner.id, limit=12)
+    if not ops:
+        await _reply(update, "📭 Операций пока нет.", full_keyboard=True)
+        return
+
+    lines = [
+        "📊 <b>Отчёт (последние операции)</b>",
+        f"🎟 Код: <code>{partner.code}</code>",
+        "",
+    ]
+    lines.extend(
+        _REPORT_ROW(
+            aid=o["appointment_id"],
+            kind=o["kind"],
+            amount=fmt_money(o["amount"]),
+            date=fmt_date(o["created_at"]),
+            status=o["status"],
+        )
+        for o in ops
     )
 
+    await _reply(update, "\n".join(lines), full_keyboard=True, parse_mode="HTML")
+
+
+async def _on_rules(update: Update, context: ContextTypes.DEFAULT_TYPE, partner: ReferralPartner):
+    await cmd_rules(update, context)
+
+
+async def _on_help(update: Update, context: ContextTypes.DEFAULT_TYPE, partner: ReferralPartner):
+    await cmd_help(update, context)
+
+
+# Кнопки -> обработчики: один поиск в dict вместо цепочки сравнений с .lower() на каждое сообщение
+_TEXT_HANDLERS = {
+    BTN_MY_CODE.lower(): _on_my_code,
+    BTN_BALANCE.lower(): _on_balance,
+    BTN_REPORT.lower(): _on_report,
+    BTN_RULES.lower(): _on_rules,
+    BTN_HELP.lower(): _on_help,
+}
+
+# до подтверждения телефона доступны только справка и правила
+_NO_PHONE_HANDLERS = {
+    BTN_HELP.lower(): cmd_help,
+    BTN_RULES.lower(): cmd_rules,
+}
+
+
+_BTN_MAX_LEN = max(map(len, (*_TEXT_HANDLERS, *_NO_PHONE_HANDLERS)))
+
 
 async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
     text = (update.message.text or "").strip()
-    text_l = text.lower()
+    # длиннее любой кнопки — точно не кнопка: длинный текст не копируем через lower()
+    text_l = text.lower() if len(text) <= _BTN_MAX_LEN else ""
     chat_id = update.effective_chat.id
 
     partner = await db_get_partner_by_chat(chat_id)
@@ -465,81 +755,25 @@ async def on_text(update: Update, context: ContextTypes.DEFAULT_TYPE):
         return
 
     if not partner_has_phone(partner):
-        if text_l == BTN_HELP.lower():
-            await cmd_help(update, context)
-            return
-        if text_l == BTN_RULES.lower():
-            await cmd_rules(update, context)
+        handler = _NO_PHONE_HANDLERS.get(text_l)
+        if handler:
+            await handler(update, context)
             return
         await _reply(update, "Сначала подтвердите номер кнопкой «Подтвердить номер».", full_keyboard=False)
         return
 
-    if not partner_has_real_code(partner):
-        await db_assign_real_code_if_needed(partner.id)
-        partner = await db_get_partner_by_chat(chat_id)
-
-    if text_l == BTN_MY_CODE.lower():
-        await _reply(
-            update,
-            (
-                "🎟 <b>Ваш реферальный код</b>\n"
-                f"<code>{partner.code}</code>\n\n"
-                "Ремонт оформляют на сайте <code>tehsfera.by</code> — при оформлении заявки вводят код."
-            ),
-            full_keyboard=True,
-            parse_mode="HTML",
-        )
-        return
-
-    if text_l == BTN_BALANCE.lower():
-        b = await db_calc_balance(partner.id)
-        text_out = (
-            "💰 <b>Баланс накоплений</b>\n"
-            f"👤 {partner.name}\n"
-            f"🎟 Код: <code>{partner.code}</code>\n\n"
-            "📌 Сводка:\n"
-            f"• Использований кода: <b>{b['uses']}</b>\n"
-            f"• Начислено (выполнено): <b>{fmt_money(b['earned_accrued'])}</b> BYN\n"
-            f"• Ожидает: <b>{fmt_money(b['earned_pending'])}</b> BYN\n"
-            f"• Использовано: <b>{fmt_money(b['spent'])}</b> BYN\n\n"
-            f"✅ <b>Доступно сейчас:</b> <b>{fmt_money(b['available'])}</b> BYN\n"
-            f"🔮 <b>Потенциал:</b> {fmt_money(b['potential'])} BYN\n\n"
-            f"🎁 Скидок клиентам: {fmt_money(b['total_discount'])} BYN"
-        )
-        await _reply(update, text_out, full_keyboard=True, parse_mode="HTML")
-        return
-
-    if text_l == BTN_REPORT.lower():
-        ops = await db_last_ops(partner.id, limit=12)
-        if not ops:
-            await _reply(update, "📭 Операций пока нет.", full_keyboard=True)
-            return
-
-        lines = [
-            "📊 <b>Отчёт (последние операции)</b>",
-            f"🎟 Код: <code>{partner.code}</code>",
-            "",
-        ]
-
-        for o in ops:
-            status_short = shorten_status_ru(o["status"])
-            lines.append(
-                f"• <b>#{o['appointment_id']}</b>  {o['kind']}  <b>{fmt_money(o['amount'])}</b> BYN\n"
-                f"  {fmt_date(o['created_at'])} • {status_short}"
-            )
-
-        await _reply(update, "\n".join(lines), full_keyboard=True, parse_mode="HTML")
-        return
-
-    if text_l == BTN_RULES.lower():
-        await cmd_rules(update, context)
+    # произвольный текст (самый частый «промах») отсекаем до выдачи кода и
+    # повторного чтения партнёра: код выдастся при первом нажатии кнопки
+    handler = _TEXT_HANDLERS.get(text_l)
+    if handler is None:
+        await _reply(update, "Используйте кнопки снизу или /help.", full_keyboard=True)
         return
 
-    if text_l == BTN_HELP.lower():
-        await cmd_help(update, context)
-        return
+    if not partner_has_real_code(partner):
+        # хелпер возвращает итоговый код — перечитывать партнёра ради него не нужно
+        partner.code = await db_assign_real_code_if_needed(partner.id)
 
-    await _reply(update, "Используйте кнопки снизу или /help.", full_keyboard=True)
+    await handler(update, context, partner)
 
 
 async def on_error(update: object, context: ContextTypes.DEFAULT_TYPE):
@@ -549,6 +783,9 @@ async def on_error(update: object, context: ContextTypes.DEFAULT_TYPE):
 # =========================
 # Run
 # =========================
+TG_CONNECTION_POOL = 16
+
+
 class Command(BaseCommand):
     help = "TG бот: подтверждение телефона -> выдача кода -> кабинет. + правила и красивый баланс/отчёт."
 
@@ -562,8 +799,22 @@ class Command(BaseCommand):
             format="%(asctime)s - %(name)s - %(levelname)s - %(message)s",
             level=logging.INFO,
         )
-
-        app = ApplicationBuilder().token(token).build()
+        # httpx пишет INFO-строку на каждый запрос к Bot API (getUpdates, sendMessage, ...):
+        # форматирование и вывод на каждый апдейт, а пользы ноль — оставляем только проблемы
+        logging.getLogger("httpx").setLevel(logging.WARNING)
+
+        # Пул соединений к Bot API шире дефолтного (1) и явные таймауты. Апдейты по-прежнему
+        # обрабатываются по одному (concurrent_updates не включаем): иначе сообщения одного
+        # чата обгоняют друг друга — двойной /start, контакт и кнопка вперемешку.
+        app = (
+            ApplicationBuilder()
+            .token(token)
+            .connection_pool_size(TG_CONNECTION_POOL)
+            .pool_timeout(5)
+            .connect_timeout(5)
+            .read_timeout(10)
+            .build()
+        )
 
         app.add_handler(CommandHandler("start", cmd_start))
         app.add_handler(CommandHandler("help", cmd_help))
@@ -576,5 +827,19 @@ class Command(BaseCommand):
 
         app.add_error_handler(on_error)
 
+        webhook_url = getattr(settings, "TELEGRAM_WEBHOOK_URL", "")
+        if webhook_url:
+            # Telegram сам присылает апдейты (Caddy: /tg -> bot:8443) — без getUpdates-цикла
+            self.stdout.write(self.style.SUCCESS(f"Бот запущен (webhook {webhook_url}). Ctrl+C для остановки."))
+            app.run_webhook(
+                listen="0.0.0.0",
+                port=8443,
+                url_path="tg",
+                webhook_url=webhook_url,
+                secret_token=getattr(settings, "TELEGRAM_WEBHOOK_SECRET", "") or None,
+                close_loop=False,
+            )
+            return
+
         self.stdout.write(self.style.SUCCESS("Бот запущен. Ctrl+C для остановки."))
         app.run_polling(close_loop=False)
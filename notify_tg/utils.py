@@ -1,29 +1,77 @@
 # notify_tg/utils.py
+import os
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from functools import lru_cache
 from django.conf import settings
-from typing import Optional, List
+from typing import Optional, List, Tuple
 import httpx
 from django.urls import reverse
 
-def send_telegram_message(chat_id: int, text: str) -> bool:
+# Один клиент на процесс: keep-alive к api.telegram.org вместо TCP+TLS на каждое сообщение.
+# Создаём лениво и заново после fork (gunicorn --preload): сокеты между воркерами не делим.
+# Там же — пул потоков для рассылки админам: потоки тоже не переживают fork.
+_SEND_CONCURRENCY = 8
+_client: Optional[httpx.Client] = None
+_send_pool: Optional[ThreadPoolExecutor] = None
+_client_pid: Optional[int] = None
+_client_lock = threading.Lock()
+
+
+def _ensure_sender() -> None:
+    global _client, _send_pool, _client_pid
+    pid = os.getpid()
+    if _client_pid != pid:
+        with _client_lock:
+            if _client_pid != pid:
+                _client = httpx.Client(
+                    timeout=10.0,
+                    limits=httpx.Limits(max_keepalive_connections=_SEND_CONCURRENCY),
+                )
+                _send_pool = ThreadPoolExecutor(max_workers=_SEND_CONCURRENCY, thread_name_prefix="tg-send")
+                _client_pid = pid
+
+
+def _get_client() -> httpx.Client:
+    _ensure_sender()
+    return _client
+
+
+@lru_cache(maxsize=4)
+def _send_message_url(token: str) -> str:
+    return f"https://api.telegram.org/bot{token}/sendMessage"
+
+
+def send_telegram_message(chat_id: int, text: str, parse_mode: Optional[str] = None,
+                          disable_web_page_preview: bool = False) -> bool:
     token = getattr(settings, "TELEGRAM_BOT_TOKEN", "")
     if not token or not chat_id:
         return False
-    url = f"https://api.telegram.org/bot{token}/sendMessage"
+    data = {"chat_id": chat_id, "text": text}
+    if parse_mode:
+        data["parse_mode"] = parse_mode
+    if disable_web_page_preview:
+        data["disable_web_page_preview"] = "true"
     try:
-        r = httpx.post(url, data={"chat_id": chat_id, "text": text})
+        r = _get_client().post(_send_message_url(token), data=data)
         ok = r.status_code == 200 and r.json().get("ok")
         return bool(ok)
     except Exception:
         return False
 
 def notify_partner(partner, text: str) -> bool:
+    """
+    partner.telegram — обратный OneToOne: без select_related("telegram") у вызывающего
+    это лишний запрос на каждого партнёра.
+    """
     tg = getattr(partner, "telegram", None)
     if not tg or not tg.is_active:
         return False
     return send_telegram_message(tg.chat_id, text)
 
 # === НОВОЕ НИЖЕ ===
-def _parse_admin_ids() -> List[int]:
+@lru_cache(maxsize=None)  # настройки в процессе не меняются — парсим один раз
+def _parse_admin_ids() -> Tuple[int, ...]:
     raw = (getattr(settings, "TELEGRAM_ADMIN_CHAT_IDS", "") or "").replace(";", ",")
     ids: List[int] = []
     for chunk in raw.split(","):
@@ -34,15 +82,17 @@ def _parse_admin_ids() -> List[int]:
             ids.append(int(chunk))
         except ValueError:
             pass
-    return ids
+    return tuple(ids)  # значение общее для всех вызовов — неизменяемое
 
 def notify_admins(text: str) -> int:
     """Шлёт сообщение всем chat_id из TELEGRAM_ADMIN_CHAT_IDS. Возвращает число удачных отправок."""
-    ok_count = 0
-    for cid in _parse_admin_ids():
-        if send_telegram_message(cid, text):
-            ok_count += 1
-    return ok_count
+    ids = _parse_admin_ids()
+    if len(ids) <= 1:
+        return sum(send_telegram_message(cid, text) for cid in ids)
+    # админам — параллельно через общий клиент (он потокобезопасен) и общий пул потоков:
+    # ~1 RTT вместо N, соединения тёплые, потоки не создаём на каждую рассылку
+    _ensure_sender()
+    return sum(_send_pool.map(lambda cid: send_telegram_message(cid, text), ids))
 
 def admin_appointment_link(appointment_id: int) -> str:
     """Возвращает относительную/абсолютную ссылку на изменение заявки в админке."""
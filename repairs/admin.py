@@ -2,8 +2,11 @@
 from __future__ import annotations
 
 import re
+from functools import lru_cache
 from django.contrib import admin, messages
-from django.db.models import Sum
+from django.db import transaction
+from django.db.models import F, Sum, Value
+from django.db.models.functions import Coalesce
 from django.shortcuts import get_object_or_404, render
 from django.urls import path, reverse
 from django.utils import timezone
@@ -17,6 +20,7 @@ from .models import (
     Technician, WorkingHour, TimeOff, Appointment,
     PageView,
 )
+from .signals import notify_redemption_paid
 
 # -------------------------------------------------------------------
 # Заголовки админки (по желанию)
@@ -30,10 +34,26 @@ admin.site.index_title = "Управление данными и заказам
 # -------------------------------------------------------------------
 _PAR_RE = re.compile(r"\s*\([^)]*\)")
 
+@lru_cache(maxsize=4096)  # названия моделей повторяются по строкам списков и в выпадающих списках
 def strip_parens_text(s: str) -> str:
     return _PAR_RE.sub("", s or "").strip()
 
 
+# -------------------------------------------------------------------
+# Бейджи статусов: статусов единицы — HTML собираем заранее
+# -------------------------------------------------------------------
+def status_badge_html(text: str, color: str):
+    return format_html(
+        '<span style="display:inline-block;padding:2px 8px;border-radius:999px;'
+        'background:{}20;color:{};border:1px solid {}33;font-size:12px">{}</span>',
+        color, color, color, text
+    )
+
+
+def build_status_badges(choices, colors: dict) -> dict:
+    return {code: status_badge_html(label, colors.get(code, "#6b7280")) for code, label in choices}
+
+
 # -------------------------------------------------------------------
 # Mixin: меняем label у FK(phone_model), скрывая текст в скобках
 # -------------------------------------------------------------------
@@ -153,31 +173,43 @@ class ReferralRedemptionAdmin(ModelAdmin):
     autocomplete_fields = ("partner", "appointment")
     ordering = ("-created_at",)
 
+    # готовые бейджи статусов — один раз на класс, а не format_html на каждую строку списка
+    STATUS_COLORS = {
+        "pending": "#f59e0b",   # amber
+        "accrued": "#10b981",   # emerald
+        "paid": "#3b82f6",      # blue
+    }
+    STATUS_BADGES = build_status_badges(ReferralRedemption.STATUS_CHOICES, STATUS_COLORS)
+
     @admin.display(description="Статус")
     def status_badge(self, obj: 'ReferralRedemption'):
-        colors = {
-            "pending": "#f59e0b",   # amber
-            "accrued": "#10b981",   # emerald
-            "paid": "#3b82f6",      # blue
-        }
-        color = colors.get(obj.status, "#6b7280")
-        text = obj.get_status_display()
-        return format_html(
-            '<span style="display:inline-block;padding:2px 8px;border-radius:999px;'
-            'background:{}20;color:{};border:1px solid {}33;font-size:12px">{}</span>',
-            color, color, color, text
-        )
+        return self.STATUS_BADGES.get(obj.status) or status_badge_html(obj.status, "#6b7280")
 
     # --- действия ---
     @admin.action(description="Отметить как выплачено")
     def mark_as_paid(self, request, queryset):
-        updated = 0
-        for r in queryset.exclude(status="paid"):
-            r.status = "paid"
-            if not r.paid_at:
-                r.paid_at = timezone.now()
-            r.save(update_fields=["status", "paid_at"])
-            updated += 1
+        # Один UPDATE вместо save() на каждую строку (каждый ещё и с SELECT в pre_save).
+        # update() идёт мимо сигналов, поэтому уведомления партнёрам шлём сами.
+        # В памяти держим только id: при «выбрать все» строк могут быть тысячи.
+        # Строки блокируем до конца транзакции: параллельное «выплачено» по тем же строкам
+        # ждёт нашего коммита и затем уже не видит их в exclude(status="paid") — уведомление
+        # уходит один раз, от того, кто строку действительно поменял.
+        with transaction.atomic():
+            ids = list(
+                ReferralRedemption.objects.select_for_update()
+                .filter(pk__in=queryset.values("pk"))
+                .exclude(status="paid")
+                .values_list("pk", flat=True)
+            )
+            updated = (
+                ReferralRedemption.objects.filter(pk__in=ids)
+                .exclude(status="paid")
+                .update(status="paid", paid_at=Coalesce(F("paid_at"), Value(timezone.now())))
+            )
+        # строки уже с итоговыми status/paid_at; партнёр с TG-привязкой — тем же запросом, потоком
+        changed = ReferralRedemption.objects.filter(pk__in=ids)
+        for r in changed.select_related("partner__telegram").iterator(chunk_size=500):
+            notify_redemption_paid(r)
         self.message_user(request, f"Отмечено выплаченными: {updated}", level=messages.SUCCESS)
 
     @admin.action(description="Снять отметку о выплате")
@@ -300,30 +332,24 @@ class AppointmentAdmin(StripPhoneModelLabelsMixin, ModelAdmin):
     def phone_model_no_parens(self, obj: Appointment):
         return strip_parens_text(getattr(obj.phone_model, "name", ""))
 
+    STATUS_COLORS = {
+        "new": "#6366f1",        # indigo
+        "confirmed": "#0ea5e9",  # sky
+        "done": "#10b981",       # emerald
+        "cancelled": "#ef4444",  # red
+    }
+    STATUS_BADGES = build_status_badges(Appointment.STATUS_CHOICES, STATUS_COLORS)
+
     @admin.display(description="Статус")
     def status_badge(self, obj: Appointment):
-        colors = {
-            "new": "#6366f1",        # indigo
-            "confirmed": "#0ea5e9",  # sky
-            "done": "#10b981",       # emerald
-            "cancelled": "#ef4444",  # red
-        }
-        color = colors.get(obj.status, "#6b7280")
-        text = obj.get_status_display()
-        return format_html(
-            '<span style="display:inline-block;padding:2px 8px;border-radius:999px;'
-            'background:{}20;color:{};border:1px solid {}33;font-size:12px">{}</span>',
-            color, color, color, text
-        )
+        return self.STATUS_BADGES.get(obj.status) or status_badge_html(obj.status, "#6b7280")
 
     # ----- уведомления при смене статуса -----
     def save_model(self, request, obj, form, change):
         old_status = None
         if change:
-            try:
-                old_status = Appointment.objects.only("status").get(pk=obj.pk).status
-            except Appointment.DoesNotExist:
-                pass
+            # одна колонка без сборки модели; .first() вернёт None, если записи нет
+            old_status = Appointment.objects.filter(pk=obj.pk).values_list("status", flat=True).first()
 
         super().save_model(request, obj, form, change)
 
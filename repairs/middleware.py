@@ -1,6 +1,76 @@
 # repairs/middleware.py
+import logging
+import os
+import queue
+import threading
+import time
+
+from django.db import close_old_connections
+
 from .models import PageView
 
+logger = logging.getLogger(__name__)
+
+# Просмотры пишем в БД фоновым потоком: запрос только кладёт строку в очередь.
+# Очередь ограничена — при перегрузке БД теряем аналитику, а не память.
+_queue: "queue.Queue[PageView]" = queue.Queue(maxsize=10000)
+_worker_lock = threading.Lock()
+_worker_pid = None
+
+
+# Пишем пачками: один INSERT на BATCH_SIZE строк или на всё, что накопилось за FLUSH_INTERVAL.
+BATCH_SIZE = 500
+FLUSH_INTERVAL = 2.0
+
+
+def _flush(batch):
+    # поток живёт вне запроса: request_started/finished тут не срабатывают, поэтому
+    # протухшее (CONN_MAX_AGE) или сломанное прошлой ошибкой соединение закрываем сами
+    close_old_connections()
+    try:
+        PageView.objects.bulk_create(batch, batch_size=BATCH_SIZE)
+    except Exception:
+        logger.exception("PageView bulk insert failed (%s rows)", len(batch))
+
+
+def _worker():
+    batch = []
+    deadline = 0.0
+    while True:
+        # пустая пачка — ждём сколько угодно; иначе — до срока, отсчитанного от первой строки
+        timeout = max(0.0, deadline - time.monotonic()) if batch else None
+        try:
+            pv = _queue.get(timeout=timeout)
+            if not batch:
+                deadline = time.monotonic() + FLUSH_INTERVAL
+            batch.append(pv)
+            if len(batch) < BATCH_SIZE and time.monotonic() < deadline:
+                continue
+        except queue.Empty:
+            pass
+        _flush(batch)
+        batch = []
+
+
+def _ensure_worker():
+    """Поток стартуем лениво и заново после fork (gunicorn --preload): потоки не наследуются."""
+    global _worker_pid
+    pid = os.getpid()
+    if _worker_pid == pid:
+        return
+    with _worker_lock:
+        if _worker_pid != pid:
+            threading.Thread(target=_worker, name="pageview-writer", daemon=True).start()
+            _worker_pid = pid
+
+
+# служебные пути и файлы — не просмотры страниц; startswith(tuple) проверяет всё за один вызов
+_IGNORED_PREFIXES = (
+    "/admin", "/static/", "/media/", "/favicon", "/robots.txt",
+    "/sw.js", "/manifest",
+)
+
+
 class AnalyticsMiddleware:
     def __init__(self, get_response):
         self.get_response = get_response
@@ -8,17 +78,28 @@ class AnalyticsMiddleware:
     def __call__(self, request):
         response = self.get_response(request)
 
-        if request.method == "GET" and not request.path.startswith('/admin'):
-            PageView.objects.create(
-                path=request.path,
-                user_agent=request.META.get("HTTP_USER_AGENT", "")[:500],
-                ip_address=self._get_ip(request),
-                referer=request.META.get("HTTP_REFERER", "")[:500],
-            )
+        if (
+            request.method == "GET"
+            and not request.path.startswith(_IGNORED_PREFIXES)
+            # считаем только отданные страницы: редиректы, 404 и JSON — не просмотры
+            and response.status_code == 200
+            and response.get("Content-Type", "").startswith("text/html")
+        ):
+            _ensure_worker()
+            try:
+                _queue.put_nowait(PageView(
+                    path=request.path,
+                    user_agent=request.META.get("HTTP_USER_AGENT", "")[:500],
+                    ip_address=self._get_ip(request),
+                    referer=request.META.get("HTTP_REFERER", "")[:500],
+                ))
+            except queue.Full:
+                pass
         return response
 
     def _get_ip(self, request):
         xff = request.META.get("HTTP_X_FORWARDED_FOR")
         if xff:
-            return xff.split(",")[0].strip()
+            # нужен только первый адрес: partition не строит список из всей цепочки прокси
+            return xff.partition(",")[0].strip()
         return request.META.get("REMOTE_ADDR")
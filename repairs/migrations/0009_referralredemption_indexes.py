@@ -0,0 +1,21 @@
+# Generated by Django 5.2.5 on 2026-10-16 14:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('repairs', '0008_analyticslink'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='referralredemption',
+            index=models.Index(fields=['partner', '-created_at'], name='rr_partner_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='referralredemption',
+            index=models.Index(condition=models.Q(('commission_amount__gt', 0)), fields=['partner', 'status'], name='rr_partner_status_idx'),
+        ),
+    ]
@@ -0,0 +1,18 @@
+# Generated by Django 5.2.5 on 2026-10-16 15:00
+
+import django.db.models.functions.text
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('repairs', '0009_referralredemption_indexes'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='referralpartner',
+            index=models.Index(django.db.models.functions.text.Upper('code'), name='refpartner_code_upper_idx'),
+        ),
+    ]
@@ -0,0 +1,29 @@
+# Generated by Django 5.2.5 on 2026-10-16 16:00
+
+from django.db import migrations, models
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('repairs', '0010_referralpartner_code_upper_idx'),
+    ]
+
+    operations = [
+        migrations.AddIndex(
+            model_name='referralredemption',
+            index=models.Index(fields=['status', '-created_at'], name='rr_status_created_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='appointment',
+            index=models.Index(fields=['-start'], name='appt_start_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='appointment',
+            index=models.Index(fields=['status', '-start'], name='appt_status_start_idx'),
+        ),
+        migrations.AddIndex(
+            model_name='pageview',
+            index=models.Index(fields=['-created_at'], name='pageview_created_idx'),
+        ),
+    ]
@@ -0,0 +1,44 @@
+# Generated by Django 5.2.5 on 2026-10-16 17:00
+
+from django.db import migrations
+from django.db.models import Count
+from django.db.models.functions import Upper
+
+
+def upper_codes(apps, schema_editor):
+    ReferralPartner = apps.get_model("repairs", "ReferralPartner")
+
+    # коды, совпадающие без учёта регистра ("abc" и "ABC"), после UPPER упрутся в unique:
+    # молча выбирать победителя нельзя — к коду привязаны начисления, разбирать вручную
+    clashes = (ReferralPartner.objects
+               .order_by()  # иначе Meta.ordering (name) попадёт в GROUP BY
+               .values(code_upper=Upper("code"))
+               .annotate(n=Count("id"))
+               .filter(n__gt=1)
+               .values_list("code_upper", flat=True))
+    clashes = sorted(clashes)
+    if clashes:
+        rows = (ReferralPartner.objects
+                .annotate(code_upper=Upper("code"))
+                .filter(code_upper__in=clashes)
+                .order_by("code_upper", "id")
+                .values_list("id", "code"))
+        details = ", ".join(f"#{pk} {code!r}" for pk, code in rows)
+        raise RuntimeError(
+            "Реферальные коды совпадают без учёта регистра: "
+            f"{', '.join(clashes)} ({details}). "
+            "Переименуйте дубликаты и повторите миграцию."
+        )
+
+    ReferralPartner.objects.exclude(code=Upper("code")).update(code=Upper("code"))
+
+
+class Migration(migrations.Migration):
+
+    dependencies = [
+        ('repairs', '0011_admin_list_indexes'),
+    ]
+
+    operations = [
+        migrations.RunPython(upper_codes, migrations.RunPython.noop),
+    ]
@@ -13,6 +13,7 @@ from decimal import Decimal
 from datetime import timedelta
 
 from django.db import models
+from django.db.models.functions import Upper
 from django.utils import timezone
 
 
@@ -118,15 +119,37 @@ class ReferralPartner(models.Model):
         verbose_name = "Партнёр (продавец)"
         verbose_name_plural = "Партнёры (продавцы)"
         ordering = ["name"]
+        indexes = [
+            # code__iexact (бот, apply_referral, сигналы) на Postgres — UPPER(code) = UPPER(%s):
+            # обычный unique-индекс по code тут не работает
+            models.Index(Upper("code"), name="refpartner_code_upper_idx"),
+        ]
 
     def __str__(self) -> str:
         return f"{self.name} ({self.code})"
 
+    def clean(self) -> None:
+        super().clean()
+        # до validate_unique: "abc" и "ABC" должны упереться в один и тот же unique
+        self.code = (self.code or "").strip().upper()
+
+    def save(self, *args, **kwargs) -> None:
+        # код храним в верхнем регистре: поиск по нему — точное равенство по unique-индексу.
+        # queryset.update()/bulk_create мимо save() — код туда передавать уже нормализованным
+        self.code = (self.code or "").strip().upper()
+        super().save(*args, **kwargs)
+
     def is_active(self) -> bool:
         if self.expires_at and self.expires_at < timezone.now():
             return False
-        if self.max_uses is not None and self.redemptions.count() >= self.max_uses:
-            return False
+        if self.max_uses is not None:
+            # списки, которые зовут is_active() на каждую строку, аннотируют
+            # _redemptions_count=Count("redemptions"); без аннотации — отдельный COUNT
+            uses = getattr(self, "_redemptions_count", None)
+            if uses is None:
+                uses = self.redemptions.count()
+            if uses >= self.max_uses:
+                return False
         return True
 
 
@@ -163,6 +186,18 @@ class ReferralRedemption(models.Model):
         constraints = [
             models.UniqueConstraint(fields=["partner", "appointment"], name="uniq_partner_appointment_redemption"),
         ]
+        indexes = [
+            # отчёты и баланс партнёра (бот, кабинет): WHERE partner ORDER BY -created_at
+            models.Index(fields=["partner", "-created_at"], name="rr_partner_created_idx"),
+            # начисления по статусу (_available_credit): списания с commission < 0 сюда не попадают
+            models.Index(
+                fields=["partner", "status"],
+                condition=models.Q(commission_amount__gt=0),
+                name="rr_partner_status_idx",
+            ),
+            # админка: фильтр по статусу + сортировка -created_at
+            models.Index(fields=["status", "-created_at"], name="rr_status_created_idx"),
+        ]
 
     def __str__(self) -> str:
         return f"{self.partner.code} → #{self.appointment_id} [{self.get_status_display()}]"
@@ -267,6 +302,11 @@ class Appointment(models.Model):
         verbose_name = "Запись"
         verbose_name_plural = "Записи"
         ordering = ["-start"]
+        indexes = [
+            # список записей в админке: ORDER BY -start, фильтр по статусу
+            models.Index(fields=["-start"], name="appt_start_idx"),
+            models.Index(fields=["status", "-start"], name="appt_status_start_idx"),
+        ]
 
     def __str__(self) -> str:
         return f"{self.customer_name} • {self.phone_model} • {self.repair_type} • {self.start:%d.%m.%Y %H:%M}"
@@ -281,7 +321,7 @@ class Appointment(models.Model):
             self.price_final = self.price_original
             return
         try:
-            partner = ReferralPartner.objects.get(code__iexact=self.referral_code)
+            partner = ReferralPartner.objects.get(code=self.referral_code.strip().upper())
         except ReferralPartner.DoesNotExist:
             self.discount_amount = Decimal("0")
             self.price_final = self.price_original
@@ -292,7 +332,12 @@ class Appointment(models.Model):
             self.price_final = self.price_original
             return
 
-        discount = (self.price_original * partner.client_discount_pct / Decimal("100")).quantize(Decimal("0.01"))
+        # цена и процент — DecimalField с 2 знаками: считаем в целых копейках и базисных
+        # пунктах; округление то же, что у quantize по умолчанию (ROUND_HALF_EVEN)
+        cents, rem = divmod(int(self.price_original * 100) * int(partner.client_discount_pct * 100), 10000)
+        if rem * 2 > 10000 or (rem * 2 == 10000 and cents % 2):
+            cents += 1
+        discount = Decimal(cents).scaleb(-2)
         self.discount_amount = discount
         self.price_final = self.price_original - discount
 
@@ -310,5 +355,11 @@ class PageView(models.Model):
     referer = models.TextField(blank=True, null=True)
     created_at = models.DateTimeField(auto_now_add=True)
 
+    class Meta:
+        indexes = [
+            # аналитика в админке: ORDER BY -created_at и фильтр по дате
+            models.Index(fields=["-created_at"], name="pageview_created_idx"),
+        ]
+
     def __str__(self):
         return f"{self.path} ({self.created_at:%Y-%m-%d %H:%M})"
\ No newline at end of file
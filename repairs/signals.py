@@ -4,7 +4,7 @@ from __future__ import annotations
 from decimal import Decimal
 
 from django.db import transaction
-from django.db.models import Sum
+from django.db.models import Q, Sum
 from django.db.models.signals import post_save, pre_save
 from django.dispatch import receiver
 from django.utils import timezone
@@ -61,19 +61,14 @@ def _available_credit(partner: ReferralPartner) -> Decimal:
       accrued (commission > 0)  -  abs(списания: commission < 0)
     Списания мы храним как отрицательные commission_amount в ReferralRedemption.
     """
-    earned_accrued = (
-        ReferralRedemption.objects
-        .filter(partner=partner, status="accrued", commission_amount__gt=0)
-        .aggregate(s=Sum("commission_amount"))["s"]
-        or Decimal("0.00")
+    # обе суммы одним запросом: агрегаты с FILTER
+    agg = ReferralRedemption.objects.filter(partner=partner).aggregate(
+        earned_accrued=Sum("commission_amount", filter=Q(status="accrued", commission_amount__gt=0)),
+        # статус можно не проверять, но обычно будет paid
+        spent=Sum("commission_amount", filter=Q(commission_amount__lt=0)),
     )
-
-    spent = (
-        ReferralRedemption.objects
-        .filter(partner=partner, commission_amount__lt=0)  # статус можно не проверять, но обычно будет paid
-        .aggregate(s=Sum("commission_amount"))["s"]
-        or Decimal("0.00")
-    )  # spent отрицательное
+    earned_accrued = agg["earned_accrued"] or Decimal("0.00")
+    spent = agg["spent"] or Decimal("0.00")  # spent отрицательное
 
     available = (Decimal(earned_accrued) + Decimal(spent)).quantize(Decimal("0.01"))
     return available
@@ -118,7 +113,7 @@ def sync_referral_on_appointment_save(sender, instance: Appointment, created: bo
     code = (instance.referral_code or "").strip()
     if code:
         try:
-            partner = ReferralPartner.objects.get(code__iexact=code)
+            partner = ReferralPartner.objects.select_related("telegram").get(code__iexact=code)
         except ReferralPartner.DoesNotExist:
             partner = None
 
@@ -321,34 +316,42 @@ def _notify_on_redemption_change(sender, instance: ReferralRedemption, created:
             pass
         instance._notify_to_accrued = False
 
-    # "paid" теперь может быть и "списание" (commission < 0), и старое "выплачено"
     if getattr(instance, "_notify_to_paid", False):
-        if instance.commission_amount < 0:
-            # списание
-            try:
-                notify_partner(
-                    instance.partner,
-                    (
-                        "Списание накоплений\n"
-                        f"Заявка #{instance.appointment_id}\n"
-                        f"Списано: {(-instance.commission_amount).quantize(Decimal('0.01'))} BYN\n"
-                        f"Дата: {instance.paid_at:%d.%m.%Y %H:%M}"
-                    ),
-                )
-            except Exception:
-                pass
-        else:
-            # если где-то ещё используется "paid" как выплата — оставим нейтральный текст
-            try:
-                notify_partner(
-                    instance.partner,
-                    (
-                        "Статус начисления изменён\n"
-                        f"Заявка #{instance.appointment_id}\n"
-                        f"Сумма: {instance.commission_amount} BYN\n"
-                        f"Дата: {instance.paid_at:%d.%m.%Y %H:%M}"
-                    ),
-                )
-            except Exception:
-                pass
+        notify_redemption_paid(instance)
         instance._notify_to_paid = False
+
+
+def notify_redemption_paid(instance: ReferralRedemption) -> None:
+    """
+    Уведомление партнёру о переходе строки в "paid". Зовётся из post_save и напрямую
+    там, где статус меняют массовым update() в обход сигналов (действие админки).
+    """
+    # "paid" теперь может быть и "списание" (commission < 0), и старое "выплачено"
+    if instance.commission_amount < 0:
+        # списание
+        try:
+            notify_partner(
+                instance.partner,
+                (
+                    "Списание накоплений\n"
+                    f"Заявка #{instance.appointment_id}\n"
+                    f"Списано: {(-instance.commission_amount).quantize(Decimal('0.01'))} BYN\n"
+                    f"Дата: {instance.paid_at:%d.%m.%Y %H:%M}"
+                ),
+            )
+        except Exception:
+            pass
+    else:
+        # если где-то ещё используется "paid" как выплата — оставим нейтральный текст
+        try:
+            notify_partner(
+                instance.partner,
+                (
+                    "Статус начисления изменён\n"
+                    f"Заявка #{instance.appointment_id}\n"
+                    f"Сумма: {instance.commission_amount} BYN\n"
+                    f"Дата: {instance.paid_at:%d.%m.%Y %H:%M}"
+                ),
+            )
+        except Exception:
+            pass
@@ -1,3 +1,252 @@
-from django.test import TestCase
+import itertools
+import queue
+from datetime import timedelta
+from decimal import Decimal
+from unittest import mock
 
-# Create your tests here.
+from django.contrib import admin as django_admin
+from django.db import connection
+from django.http import HttpResponse, JsonResponse
+from django.test import RequestFactory, SimpleTestCase, TestCase, skipUnlessDBFeature
+from django.test.utils import CaptureQueriesContext
+from django.utils import timezone
+
+from . import middleware
+from .admin import ReferralRedemptionAdmin
+from .models import (
+    Appointment, PageView, PhoneBrand, PhoneModel, ReferralPartner, ReferralRedemption, RepairType,
+)
+
+
+class ApplyReferralTests(TestCase):
+    def _apply(self, price: str, pct: str, code: str = "PARTNER1") -> Appointment:
+        ReferralPartner.objects.create(name="Партнёр", code="PARTNER1", client_discount_pct=Decimal(pct))
+        a = Appointment(referral_code=code, price_original=Decimal(price))
+        a.apply_referral()
+        return a
+
+    def test_half_cent_rounds_down_to_even(self):
+        a = self._apply("2.50", "5.00")  # 0.125
+        self.assertEqual(a.discount_amount, Decimal("0.12"))
+        self.assertEqual(a.price_final, Decimal("2.38"))
+
+    def test_half_cent_rounds_up_to_even(self):
+        a = self._apply("2.70", "5.00")  # 0.135
+        self.assertEqual(a.discount_amount, Decimal("0.14"))
+        self.assertEqual(a.price_final, Decimal("2.56"))
+
+    def test_zero_discount(self):
+        a = self._apply("123.45", "0.00")
+        self.assertEqual(a.discount_amount, Decimal("0.00"))
+        self.assertEqual(a.price_final, Decimal("123.45"))
+
+    def test_code_is_case_insensitive(self):
+        a = self._apply("100.00", "5.00", code=" partner1 ")
+        self.assertEqual(a.discount_amount, Decimal("5.00"))
+
+    def test_unknown_code_gives_no_discount(self):
+        a = self._apply("100.00", "5.00", code="NOPE")
+        self.assertEqual(a.discount_amount, Decimal("0"))
+        self.assertEqual(a.price_final, Decimal("100.00"))
+
+
+class MarkAsPaidTests(TestCase):
+    @classmethod
+    def setUpTestData(cls):
+        brand = PhoneBrand.objects.create(name="Apple", slug="apple")
+        model = PhoneModel.objects.create(brand=brand, name="iPhone 11", slug="iphone-11")
+        repair = RepairType.objects.create(name="Замена экрана", slug="screen")
+        cls.partner = ReferralPartner.objects.create(name="Партнёр", code="PARTNER1")
+        start = timezone.now()
+        with mock.patch("repairs.signals.notify_admins"):
+            appointments = [
+                Appointment.objects.create(
+                    phone_model=model, repair_type=repair, start=start, end=start + timedelta(hours=1),
+                    customer_name="Клиент", customer_phone=f"+37529000000{i}",
+                    price_original=Decimal("100.00"), price_final=Decimal("100.00"),
+                )
+                for i in range(3)
+            ]
+        cls.old_paid_at = start - timedelta(days=1)
+        cls.accrued = [
+            ReferralRedemption.objects.create(
+                partner=cls.partner, appointment=a, phone=a.customer_phone,
+                discount_amount=Decimal("5.00"), commission_amount=Decimal("5.00"), status="accrued",
+            )
+            for a in appointments[:2]
+        ]
+        cls.paid = ReferralRedemption.objects.create(
+            partner=cls.partner, appointment=appointments[2], phone=appointments[2].customer_phone,
+            discount_amount=Decimal("5.00"), commission_amount=Decimal("5.00"),
+            status="paid", paid_at=cls.old_paid_at,
+        )
+
+    def _mark_as_paid(self, queryset):
+        model_admin = ReferralRedemptionAdmin(ReferralRedemption, django_admin.site)
+        request = RequestFactory().post("/")
+        with mock.patch.object(model_admin, "message_user") as message_user, \
+                mock.patch("repairs.signals.notify_partner") as notify_partner:
+            model_admin.mark_as_paid(request, queryset)
+        return notify_partner, message_user
+
+    def test_notifies_once_per_changed_row(self):
+        notify_partner, message_user = self._mark_as_paid(ReferralRedemption.objects.all())
+
+        self.assertEqual(notify_partner.call_count, 2)
+        for call in notify_partner.call_args_list:
+            self.assertEqual(call.args[0], self.partner)
+        self.assertEqual(message_user.call_args.args[1], "Отмечено выплаченными: 2")
+
+        for r in self.accrued:
+            r.refresh_from_db()
+            self.assertEqual(r.status, "paid")
+            self.assertIsNotNone(r.paid_at)
+
+    def test_keeps_existing_paid_at(self):
+        self._mark_as_paid(ReferralRedemption.objects.all())
+        self.paid.refresh_from_db()
+        self.assertEqual(self.paid.paid_at, self.old_paid_at)
+
+    def test_already_paid_rows_are_not_notified(self):
+        notify_partner, _ = self._mark_as_paid(ReferralRedemption.objects.filter(pk=self.paid.pk))
+        notify_partner.assert_not_called()
+
+    @skipUnlessDBFeature("has_select_for_update")
+    def test_locks_rows_before_update(self):
+        with CaptureQueriesContext(connection) as ctx:
+            self._mark_as_paid(ReferralRedemption.objects.all())
+        sql = [q["sql"] for q in ctx.captured_queries]
+        lock = next(i for i, q in enumerate(sql) if "FOR UPDATE" in q)
+        update = next(i for i, q in enumerate(sql) if q.startswith("UPDATE"))
+        self.assertLess(lock, update)
+
+
+class AnalyticsMiddlewareTests(TestCase):
+    def setUp(self):
+        # своя очередь и без фонового потока: пачку пишем синхронно через _flush.
+        # close_old_connections внутри транзакции TestCase пометил бы её на откат
+        # (тестовый клиент Django отключает его по той же причине)
+        self.queue = queue.Queue()
+        for patcher in (
+            mock.patch.object(middleware, "_queue", self.queue),
+            mock.patch.object(middleware, "_ensure_worker"),
+            mock.patch.object(middleware, "close_old_connections"),
+        ):
+            patcher.start()
+            self.addCleanup(patcher.stop)
+        self.factory = RequestFactory()
+
+    def _request(self, path="/", method="get", response=None, **meta):
+        mw = middleware.AnalyticsMiddleware(lambda request: response or HttpResponse("<html></html>"))
+        mw(getattr(self.factory, method)(path, **meta))
+
+    def _drain(self) -> list:
+        batch = []
+        while True:
+            try:
+                batch.append(self.queue.get_nowait())
+            except queue.Empty:
+                break
+        if batch:
+            middleware._flush(batch)
+        return batch
+
+    def test_html_page_is_written(self):
+        self._request(
+            "/repairs/", HTTP_USER_AGENT="x" * 600, HTTP_REFERER="https://example.com/", REMOTE_ADDR="198.51.100.7",
+        )
+        self.assertEqual(len(self._drain()), 1)
+        pv = PageView.objects.get()
+        self.assertEqual(pv.path, "/repairs/")
+        self.assertEqual(len(pv.user_agent), 500)
+        self.assertEqual(pv.referer, "https://example.com/")
+        self.assertEqual(pv.ip_address, "198.51.100.7")
+
+    def test_non_pages_are_skipped(self):
+        self._request("/", method="post")
+        self._request("/", response=HttpResponse(status=302))
+        self._request("/", response=HttpResponse("<html></html>", status=404))
+        self._request("/", response=JsonResponse({"ok": True}))
+        for path in ("/admin/", "/static/app.css", "/media/x.jpg", "/favicon.ico", "/robots.txt",
+                     "/sw.js", "/manifest.json"):
+            self._request(path)
+        self.assertEqual(self._drain(), [])
+        self.assertFalse(PageView.objects.exists())
+
+    def test_payments_pages_are_counted(self):
+        self._request("/payments/success/")
+        self.assertEqual([pv.path for pv in self._drain()], ["/payments/success/"])
+
+    def test_ip_from_x_forwarded_for(self):
+        self._request(HTTP_X_FORWARDED_FOR=" 203.0.113.5 , 10.0.0.1, 10.0.0.2", REMOTE_ADDR="10.0.0.2")
+        self._request(REMOTE_ADDR="198.51.100.7")
+        self.assertEqual([pv.ip_address for pv in self._drain()], ["203.0.113.5", "198.51.100.7"])
+
+    def test_full_queue_drops_row(self):
+        with mock.patch.object(middleware, "_queue", queue.Queue(maxsize=1)) as small:
+            self._request("/a/")
+            self._request("/b/")
+            self.assertEqual(small.get_nowait().path, "/a/")
+            self.assertTrue(small.empty())
+
+
+class _Stop(Exception):
+    pass
+
+
+class _ScriptedQueue:
+    """Очередь для _worker: отдаёт строки по сценарию, queue.Empty — «таймаут», _Stop — выход из цикла."""
+
+    def __init__(self, *script):
+        self.script = list(script)
+        self.timeouts = []
+
+    def get(self, timeout=None):
+        self.timeouts.append(timeout)
+        item = self.script.pop(0)
+        if isinstance(item, type) and issubclass(item, Exception):
+            raise item
+        return item
+
+
+class PageViewWorkerTests(SimpleTestCase):
+    def _run(self, q: _ScriptedQueue, clock=itertools.repeat(0.0), batch_size=3) -> list:
+        flushed = []
+        clock = iter(clock)
+        with mock.patch.object(middleware, "_queue", q), \
+                mock.patch.object(middleware, "_flush", lambda batch: flushed.append(list(batch))), \
+                mock.patch.object(middleware, "BATCH_SIZE", batch_size), \
+                mock.patch.object(middleware, "FLUSH_INTERVAL", 2.0), \
+                mock.patch.object(middleware, "time", mock.Mock(monotonic=lambda: next(clock))):
+            with self.assertRaises(_Stop):
+                middleware._worker()
+        return flushed
+
+    def test_flushes_full_batch(self):
+        flushed = self._run(_ScriptedQueue(1, 2, 3, 4, _Stop))
+        self.assertEqual(flushed, [[1, 2, 3]])
+
+    def test_flushes_on_interval(self):
+        q = _ScriptedQueue(1, 2, queue.Empty, _Stop)
+        flushed = self._run(q)
+        self.assertEqual(flushed, [[1, 2]])
+        # пустая пачка ждёт без срока, непустая — до срока от первой строки
+        self.assertEqual(q.timeouts, [None, 2.0, 2.0, None])
+
+    def test_flushes_row_arriving_after_deadline(self):
+        # первая строка в t=0 (срок 2.0), вторая приходит уже в t=5
+        flushed = self._run(_ScriptedQueue(1, 2, _Stop), clock=itertools.chain([0.0, 0.0, 0.0], itertools.repeat(5.0)))
+        self.assertEqual(flushed, [[1, 2]])
+
+    def test_worker_restarts_after_fork(self):
+        with mock.patch.object(middleware, "_worker_pid", None), \
+                mock.patch.object(middleware.threading, "Thread") as thread, \
+                mock.patch.object(middleware.os, "getpid", return_value=100) as getpid:
+            middleware._ensure_worker()
+            middleware._ensure_worker()
+            self.assertEqual(thread.return_value.start.call_count, 1)
+
+            getpid.return_value = 200  # дочерний процесс gunicorn --preload
+            middleware._ensure_worker()
+            self.assertEqual(thread.return_value.start.call_count, 2)
+            self.assertEqual(thread.call_args.kwargs["target"], middleware._worker)